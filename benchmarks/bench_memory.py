@@ -0,0 +1,81 @@
+import argparse, gc, json, os, sys, tracemalloc
+from datetime import datetime, timedelta
+
+import pytz
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pluto
+import fixtures
+
+# Memory held by a multi-country, 36 hour guide in each in-memory representation, measured with tracemalloc:
+#   raw per country  - decoded /v2/guide/timelines bodies kept for every country (the original epg_data)
+#   raw shared       - decoded timelines kept once per unique channel
+#   compact records  - Programme records with interned strings, once per unique channel (the epg_store)
+#
+#   python benchmarks/bench_memory.py [--countries 6] [--channels 200] [--overlap 0.75]
+
+
+def country_channels(country, channels, overlap):
+    # Same partial overlap between countries as fake_pluto.py
+    start = int((country % 4) * channels * (1 - overlap) / 3)
+    return [fixtures.channel_id(index) for index in range(start, start + channels)]
+
+def responses(channel_ids, start, range_count=3):
+    # Upstream bodies for the three 720 minute windows, decoded from JSON as the Client receives them
+    for i in range(range_count):
+        window_start = (start + timedelta(minutes=720 * i)).strftime("%Y-%m-%dT%H:00:00.000Z")
+        for group in range(0, len(channel_ids), 100):
+            yield json.loads(json.dumps(fixtures.timelines(channel_ids[group:group + 100], window_start, 720)))
+
+def measure(build):
+    gc.collect()
+    tracemalloc.start()
+    data = build()
+    gc.collect()
+    current = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return data, current
+
+def main():
+    parser = argparse.ArgumentParser(description="Memory used by the in-memory EPG representations")
+    parser.add_argument("--countries", type=int, default=6)
+    parser.add_argument("--channels", type=int, default=200, help="channels per country")
+    parser.add_argument("--overlap", type=float, default=0.75, help="share of channels countries have in common")
+    args = parser.parse_args()
+
+    start = datetime.now(pytz.utc).replace(minute=0, second=0, microsecond=0)
+    countries = [country_channels(country, args.channels, args.overlap) for country in range(args.countries)]
+    unique_ids = list(dict.fromkeys(channel_id for channel_ids in countries for channel_id in channel_ids))
+
+    def raw_per_country():
+        return [list(responses(channel_ids, start)) for channel_ids in countries]
+
+    def raw_shared():
+        store = {}
+        for body in responses(unique_ids, start):
+            for entry in body["data"]:
+                store.setdefault(entry["channelId"], []).extend(entry["timelines"])
+        return store
+
+    def compact():
+        store = {}
+        for body in responses(unique_ids, start):
+            for entry in body["data"]:
+                store.setdefault(entry["channelId"], []).extend(pluto.Programme.from_timeline(timeline) for timeline in entry["timelines"])
+        return store
+
+    results = []
+    for label, build in (("raw per country", raw_per_country), ("raw shared", raw_shared), ("compact records", compact)):
+        data, size = measure(build)
+        results.append((label, size))
+        del data
+
+    programmes = sum(len(timelines) for timelines in compact().values())
+    print(f"{args.countries} countries x {args.channels} channels, {len(unique_ids)} unique channels, {programmes} programmes")
+    print(f"{'representation':<18} {'MB':>9} {'vs raw':>8}")
+    baseline = results[0][1]
+    for label, size in results:
+        print(f"{label:<18} {size / 1e6:>9.1f} {baseline / size:>7.1f}x")
+
+if __name__ == "__main__":
+    main()
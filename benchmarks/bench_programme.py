@@ -0,0 +1,94 @@
+import argparse, os, re, sys, timeit
+from datetime import datetime
+
+import pytz
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pluto
+import fixtures
+
+# Microbenchmark for the per-programme conversion in read_epg_data.
+# Each step is timed against the implementation read_epg_data used before the
+# genre index and timestamp cache were introduced.
+#
+#   python benchmarks/bench_programme.py [--channels 100] [--repeat 5]
+
+
+def legacy_find_tuples_by_value(dictionary, target_value):
+    result_list = []
+    for key, values in dictionary.items():
+        if target_value in values:
+            result_list.extend(key)
+    return result_list if result_list else [target_value]
+
+def legacy_genres(episode):
+    series_genres = dict(pluto.SERIES_GENRES)
+    categories = []
+    categories.extend(legacy_find_tuples_by_value(series_genres, episode["genre"]))
+    categories.extend(legacy_find_tuples_by_value(series_genres, episode["subGenre"]))
+    unique_list = []
+    for item in categories:
+        if item not in unique_list:
+            unique_list.append(item)
+    return unique_list
+
+def indexed_genres(episode):
+    categories = dict.fromkeys(pluto.genre_categories(episode["genre"]))
+    categories.update(dict.fromkeys(pluto.genre_categories(episode["subGenre"])))
+    return list(categories)
+
+def legacy_times(timeline):
+    release = timeline["episode"]["clip"]["originalReleaseDate"]
+    return (datetime.strptime(timeline["start"], "%Y-%m-%dT%H:%M:%S.%fZ").replace(tzinfo=pytz.utc).strftime("%Y%m%d%H%M%S %z"),
+            datetime.strptime(timeline["stop"], "%Y-%m-%dT%H:%M:%S.%fZ").replace(tzinfo=pytz.utc).strftime("%Y%m%d%H%M%S %z"),
+            datetime.strptime(release, "%Y-%m-%dT%H:%M:%S.%fZ").replace(tzinfo=pytz.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + 'Z',
+            datetime.strptime(release, "%Y-%m-%dT%H:%M:%S.%fZ").strftime("%Y%m%d"))
+
+def cached_times(timeline):
+    return (pluto.xmltv_time(timeline["start"]), pluto.xmltv_time(timeline["stop"]),
+            *pluto.air_date(timeline["episode"]["clip"]["originalReleaseDate"]))
+
+def legacy_strip(text):
+    return re.compile(r'[\x00-\x08\x0b\x0c\x0e-\x1f]').sub('', text)
+
+def compiled_strip(text):
+    return pluto.ILLEGAL_CHAR_PATTERN.sub('', text)
+
+
+def measure(label, legacy, current, items, repeat):
+    # Both versions must agree before their speed is compared
+    for item in items:
+        assert legacy(item) == current(item), f"{label}: results differ for {item!r}"
+    legacy_time = min(timeit.repeat(lambda: [legacy(item) for item in items], number=1, repeat=repeat))
+    current_time = min(timeit.repeat(lambda: [current(item) for item in items], number=1, repeat=repeat))
+    print(f"{label:<22} {legacy_time * 1e6 / len(items):>10.2f} {current_time * 1e6 / len(items):>10.2f} {legacy_time / current_time:>8.1f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-programme EPG conversion microbenchmark")
+    parser.add_argument("--channels", type=int, default=100, help="channels in the synthetic guide")
+    parser.add_argument("--repeat", type=int, default=5, help="timing repetitions, best is reported")
+    args = parser.parse_args()
+
+    start = datetime.now(pytz.utc).strftime("%Y-%m-%dT%H:00:00.000Z")
+    guide = fixtures.timelines([fixtures.channel_id(i) for i in range(args.channels)], start, 720)
+    timelines = [timeline for entry in guide["data"] for timeline in entry["timelines"]]
+    episodes = [timeline["episode"] for timeline in timelines]
+    texts = [episode["description"] for episode in episodes]
+
+    print(f"{len(timelines)} programmes, microseconds per programme")
+    print(f"{'step':<22} {'legacy':>10} {'current':>10} {'speedup':>9}")
+    measure("genre categories", legacy_genres, indexed_genres, episodes, args.repeat)
+    measure("timestamps", legacy_times, cached_times, timelines, args.repeat)
+    measure("illegal characters", legacy_strip, compiled_strip, texts, args.repeat)
+
+    # programme_record renders the compact records the guide store holds
+    client = pluto.Client()
+    programmes = [(entry["channelId"], pluto.Programme.from_timeline(timeline))
+                  for entry in guide["data"] for timeline in entry["timelines"]]
+    render = min(timeit.repeat(lambda: [client.programme_record(channel_id, programme) for channel_id, programme in programmes],
+                               number=1, repeat=args.repeat))
+    print(f"{'programme_record':<22} {'':>10} {render * 1e6 / len(timelines):>10.2f}")
+
+if __name__ == "__main__":
+    main()
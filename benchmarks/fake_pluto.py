@@ -0,0 +1,156 @@
+import argparse, hashlib, json, os, random, sys, threading, time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fixtures
+
+# Local stand-in for the Pluto endpoints the Client uses:
+#   /v4/start                 (boot.pluto.tv)
+#   /v2/guide/channels        (service-channels)
+#   /v2/guide/categories
+#   /v2/guide/timelines
+# plus /_stats, which reports the requests served so far.
+# --error-rate and --tail-rate/--tail-latency make a share of timelines requests fail with a 503
+# or respond slowly, to exercise retries, hedging and the circuit breaker.
+#
+# Point the Client at it with PLUTO_BOOT_URL and PLUTO_API_URL:
+#   python benchmarks/fake_pluto.py --port 8089 --channels 400 --latency 0.05
+#   PLUTO_BOOT_URL=http://127.0.0.1:8089 PLUTO_API_URL=http://127.0.0.1:8089 python pywsgi.py
+
+
+class FakePluto:
+    def __init__(self, channels=400, latency=0.0, latency_per_channel=0.0, overlap=0.75, record_dir=None,
+                 error_rate=0.0, tail_rate=0.0, tail_latency=0.0):
+        self.channels = channels
+        self.latency = latency
+        self.latency_per_channel = latency_per_channel
+        self.error_rate = error_rate
+        self.tail_rate = tail_rate
+        self.tail_latency = tail_latency
+        self.overlap = overlap
+        self.recorded = self.load_recorded(record_dir) if record_dir else {}
+        self.lock = threading.Lock()
+        self.requests = Counter()
+        self.bytes_sent = 0
+
+    def load_recorded(self, record_dir):
+        # Recorded responses: boot.json, channels.json, categories.json, timelines.json (any subset)
+        recorded = {}
+        for name in ("boot", "channels", "categories", "timelines"):
+            path = os.path.join(record_dir, f"{name}.json")
+            if os.path.exists(path):
+                with open(path, encoding="utf-8") as f:
+                    recorded[name] = json.load(f)
+        return recorded
+
+    def country_range(self, forwarded_for):
+        # Each X-Forwarded-For address sees a shifted window of channels, so countries partly overlap
+        if not forwarded_for:
+            return range(self.channels)
+        shift = int(hashlib.md5(forwarded_for.encode()).hexdigest(), 16) % 4
+        start = int(shift * self.channels * (1 - self.overlap) / 3)
+        return range(start, start + self.channels)
+
+    def respond(self, path, params, headers):
+        if path == "/v4/start":
+            return self.recorded.get("boot") or fixtures.boot(headers.get("X-Forwarded-For", ""))
+
+        if path == "/v2/guide/channels":
+            if "channels" in self.recorded:
+                return self.recorded["channels"]
+            return fixtures.channels(self.country_range(headers.get("X-Forwarded-For")))
+
+        if path == "/v2/guide/categories":
+            if "categories" in self.recorded:
+                return self.recorded["categories"]
+            return fixtures.categories(self.country_range(headers.get("X-Forwarded-For")))
+
+        if path == "/v2/guide/timelines":
+            channel_ids = [cid for cid in params.get("channelIds", "").split(",") if cid]
+            if self.latency_per_channel:
+                time.sleep(self.latency_per_channel * len(channel_ids) * int(params.get("duration", 720)) / 720)
+            if "timelines" in self.recorded:
+                wanted = set(channel_ids)
+                recorded = self.recorded["timelines"]
+                return dict(recorded, data=[entry for entry in recorded["data"] if entry["channelId"] in wanted])
+            return fixtures.timelines(channel_ids, params["start"], params.get("duration", 720))
+
+        if path == "/_stats":
+            with self.lock:
+                return {"requests": dict(self.requests), "bytes_sent": self.bytes_sent}
+
+        return None
+
+    def handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                params = {key: values[-1] for key, values in parse_qs(url.query, keep_blank_values=True).items()}
+                if fake.latency and url.path != "/_stats":
+                    time.sleep(fake.latency)
+                if url.path == "/v2/guide/timelines" and random.random() < fake.tail_rate:
+                    time.sleep(fake.tail_latency)
+                try:
+                    if url.path == "/v2/guide/timelines" and random.random() < fake.error_rate:
+                        data, status = {"error": "Injected failure"}, 503
+                    else:
+                        data = fake.respond(url.path, params, self.headers)
+                        status = 200 if data is not None else 404
+                except Exception as e:
+                    data, status = {"error": f"{type(e).__name__}: {e}"}, 500
+                body = json.dumps(data).encode("utf-8")
+
+                if url.path != "/_stats":
+                    with fake.lock:
+                        fake.requests[url.path] += 1
+                        fake.bytes_sent += len(body)
+
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def serve(self, host="127.0.0.1", port=8089):
+        server = ThreadingHTTPServer((host, port), self.handler())
+        server.daemon_threads = True
+        return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the Pluto boot and guide APIs")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--channels", type=int, default=400, help="synthetic channels per country")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument("--latency-per-channel", type=float, default=0.0,
+                        help="extra seconds per channel in a 720 minute timelines request")
+    parser.add_argument("--overlap", type=float, default=0.75, help="share of channels countries have in common")
+    parser.add_argument("--record-dir", help="directory of recorded boot/channels/categories/timelines JSON")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of timelines requests answered with a 503")
+    parser.add_argument("--tail-rate", type=float, default=0.0, help="share of timelines requests delayed by --tail-latency")
+    parser.add_argument("--tail-latency", type=float, default=0.0, help="seconds added to a delayed timelines request")
+    args = parser.parse_args()
+
+    fake = FakePluto(args.channels, args.latency, args.latency_per_channel, args.overlap, args.record_dir,
+                     args.error_rate, args.tail_rate, args.tail_latency)
+    server = fake.serve(args.host, args.port)
+    print(f"Fake Pluto API on http://{args.host}:{server.server_address[1]}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
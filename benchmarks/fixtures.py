@@ -0,0 +1,92 @@
+from datetime import datetime, timedelta
+
+# Synthetic Pluto API payloads for benchmarks.
+# Every value is derived from the channel index and the programme start time,
+# so overlapping requests always describe the same programme the same way.
+
+GENRES = ["Action & Adventure", "Kids", "News and Information", "Crime Drama", "Documentaries",
+          "Classic Comedies", "Reality", "Food & Wine", "Sci-Fi Thrillers", "Westerns", "Anime"]
+SERIES_TYPES = ["tv", "film", "live"]
+CATEGORIES = ["News + Opinion", "Movies", "Comedy", "Drama", "Kids", "Reality", "Sports", "Local"]
+
+
+def channel_id(index):
+    return f"{index:024x}"
+
+def channel(index):
+    return {"id": channel_id(index),
+            "name": f"Channel {index} & Friends",
+            "slug": f"channel-{index}",
+            "tmsid": str(100000 + index) if index % 4 == 0 else None,
+            "summary": f"Around the clock programming for channel {index}.\x07",
+            # Every tenth channel shares its number with the next one, as Pluto's list does
+            "number": 100 + index - index // 10,
+            "images": [{"type": "logo", "url": f"https://images.example/{index}/logo.png"},
+                       {"type": "colorLogoPNG", "url": f"https://images.example/{index}/colorLogoPNG.png"}]}
+
+def channels(indexes):
+    return {"data": [channel(index) for index in indexes]}
+
+def categories(indexes):
+    data = [{"name": name, "channelIDs": []} for name in CATEGORIES]
+    for index in indexes:
+        data[index % len(CATEGORIES)]["channelIDs"].append(channel_id(index))
+    return {"data": data}
+
+def parse_time(value):
+    return datetime.strptime(value, "%Y-%m-%dT%H:%M:%S.%fZ")
+
+def format_time(value):
+    return value.strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+# Programme lengths in minutes; each pattern fills a two hour block exactly
+BLOCK_PATTERNS = [(30, 30, 60), (60, 60), (120,), (30, 90), (15, 45, 60)]
+
+def timeline(index, start, stop):
+    seed = index + int(start.timestamp()) // 60
+    series_type = SERIES_TYPES[seed % len(SERIES_TYPES)]
+    release = start if series_type == "live" else datetime(1990 + seed % 30, 1 + seed % 12, 1 + seed % 28, 20, 0)
+    series_id = f"{index % 50:024x}"
+    episode = {"_id": f"{seed:024x}",
+               "name": f"Episode {seed % 40}",
+               "number": 1 + seed % 22,
+               "season": 1 + seed % 9,
+               "description": f"Description for episode {seed % 40} of series {index % 50}, with &quot;quotes&quot; & more.",
+               "duration": int((stop - start).total_seconds() * 1000),
+               "genre": GENRES[seed % len(GENRES)],
+               "subGenre": GENRES[(seed * 7) % len(GENRES)],
+               "rating": "TV-14",
+               "clip": {"_id": f"{seed + 1:024x}", "name": f"Episode {seed % 40}",
+                        "originalReleaseDate": format_time(release)},
+               "series": {"_id": series_id, "name": f"Series {index % 50}", "slug": f"series-{index % 50}",
+                          "type": series_type, "tile": {"path": f"https://images.example/series/{series_id}/tile.jpg?w=300&h=300"},
+                          "featuredImage": {"path": f"https://images.example/series/{series_id}/featured.jpg"}},
+               "poster": {"path": f"https://images.example/episode/{seed:024x}/poster.jpg"},
+               "thumbnail": {"path": f"https://images.example/episode/{seed:024x}/thumb.jpg"}}
+    return {"_id": f"{seed + 2:024x}", "start": format_time(start), "stop": format_time(stop),
+            "title": f"Series {index % 50}" if seed % 3 else f"episode {seed % 40}", "episode": episode}
+
+def channel_timelines(index, start, stop):
+    # Programmes never cross a two hour block boundary, so any window sees the same schedule
+    block = start.replace(hour=start.hour - start.hour % 2, minute=0, second=0, microsecond=0)
+    entries = []
+    while block < stop:
+        slot = block
+        for length in BLOCK_PATTERNS[(index + block.hour // 2) % len(BLOCK_PATTERNS)]:
+            end = slot + timedelta(minutes=length)
+            if end > start and slot < stop:
+                entries.append(timeline(index, slot, end))
+            slot = end
+        block += timedelta(hours=2)
+    return entries
+
+def timelines(channel_ids, start, duration):
+    start = parse_time(start)
+    stop = start + timedelta(minutes=int(duration))
+    data = [{"channelId": cid, "timelines": channel_timelines(int(cid, 16), start, stop)} for cid in channel_ids]
+    return {"meta": {"startDateTime": format_time(start), "endDateTime": format_time(stop)}, "data": data}
+
+def boot(country_code):
+    return {"sessionToken": f"token-{country_code}",
+            "stitcherParams": "sid=benchmark&deviceId=benchmark",
+            "session": {"sessionID": f"session-{country_code}"}}
@@ -0,0 +1,209 @@
+import argparse, json, os, resource, subprocess, sys, tempfile, time, urllib.request
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+RESULT_PREFIX = "BENCHMARK_RESULT "
+
+# End-to-end benchmarks against the local Pluto stand-in (benchmarks/fake_pluto.py).
+# Each scenario runs in its own process so peak RSS is measured per scenario.
+# refresh_latency and refresh_latency_inprocess compare request latency during an EPG
+# refresh with the EPG worker process enabled and disabled (PLUTO_EPG_PROCESS=0).
+#
+#   python benchmarks/run.py
+#   python benchmarks/run.py --channels 800 --latency 0.05 --scenario epg_scheduler --json
+#   python benchmarks/run.py --sweep --latency 0.05 --latency-per-channel 0.002
+
+
+def upstream_requests(api_url):
+    with urllib.request.urlopen(f"{api_url}/_stats") as response:
+        return sum(json.load(response)["requests"].values())
+
+def route_rate(client, path, count):
+    # Requests per second for a Flask route, after one warm-up request
+    response = client.get(path)
+    assert response.status_code < 400, f"{path} returned {response.status_code}"
+    start = time.perf_counter()
+    for i in range(count):
+        client.get(path)
+    return count / (time.perf_counter() - start)
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else 0.0
+
+def refresh_latency(pywsgi, country_code, args):
+    # Playlist and watch latency seen by HTTP clients while a full EPG refresh runs on the same server
+    import gevent
+    from gevent.pywsgi import WSGIServer
+    server = WSGIServer(("127.0.0.1", 0), pywsgi.app, log=None)
+    server.start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    paths = [f"/pluto/{country_code}/playlist.m3u", f"/pluto/{country_code}/watch/5421f71da6af422839419cb3"]
+    pywsgi.providers[pywsgi.provider].channels(country_code)
+    latencies = []
+
+    def load(refresh, path):
+        while not refresh.ready():
+            start = time.perf_counter()
+            with urllib.request.urlopen(base_url + path) as response:
+                response.read()
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    refresh = gevent.spawn(pywsgi.refresh_scheduler.run_all)
+    clients = [gevent.spawn(load, refresh, paths[i % len(paths)]) for i in range(args.concurrency)]
+    gevent.joinall([refresh] + clients)
+    elapsed = time.perf_counter() - start
+    server.stop()
+    return {"requests_per_sec": len(latencies) / elapsed,
+            "p50_ms": percentile(latencies, 0.50) * 1000,
+            "p99_ms": percentile(latencies, 0.99) * 1000,
+            "max_ms": max(latencies, default=0.0) * 1000}
+
+def run_scenario(name, args):
+    # Runs inside the child process; pywsgi reads its configuration from the environment on import
+    sys.path.insert(0, REPO_DIR)
+    import pywsgi
+    # EPG files are written to the working directory and served relative to the app root
+    pywsgi.app.root_path = os.getcwd()
+    client = pywsgi.providers[pywsgi.provider]
+    country_code = pywsgi.pluto_country_list[0]
+    result = {}
+
+    before = upstream_requests(args.api_url)
+    start = time.perf_counter()
+    if name == "create_xml_file":
+        client.create_xml_file(country_code)
+        result["artifact_bytes"] = os.path.getsize(f"epg-{country_code}.xml")
+    elif name == "create_xml_file_adapted":
+        # A first build teaches the batch planner; only the second, from an empty guide store, is measured
+        client.create_xml_file(country_code)
+        client.epg_store.clear()
+        before = upstream_requests(args.api_url)
+        start = time.perf_counter()
+        client.create_xml_file(country_code)
+    elif name == "epg_scheduler":
+        # One pass of the server's refresh jobs: the fetch of every country, then the builds
+        pywsgi.refresh_scheduler.run_all()
+        result["artifact_bytes"] = os.path.getsize("epg-all.xml")
+    elif name in ("refresh_latency", "refresh_latency_inprocess"):
+        result.update(refresh_latency(pywsgi, country_code, args))
+    else:
+        test_client = pywsgi.app.test_client()
+        if name == "playlist":
+            result["requests_per_sec"] = route_rate(test_client, f"/pluto/{country_code}/playlist.m3u", args.requests)
+        elif name == "playlist_all":
+            for code in pywsgi.pluto_country_list:
+                client.channels(code)
+            result["requests_per_sec"] = route_rate(test_client, "/pluto/all/playlist.m3u", args.requests)
+        elif name == "watch":
+            result["requests_per_sec"] = route_rate(test_client, f"/pluto/{country_code}/watch/5421f71da6af422839419cb3", args.requests)
+        elif name == "epg_xml":
+            client.create_xml_file(country_code)
+            result["requests_per_sec"] = route_rate(test_client, f"/pluto/epg/{country_code}/epg-{country_code}.xml", args.requests)
+        else:
+            raise SystemExit(f"Unknown scenario {name}")
+    result["wall_sec"] = time.perf_counter() - start
+    result["upstream_requests"] = upstream_requests(args.api_url) - before
+    # ru_maxrss is reported in kilobytes on Linux
+    result["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return result
+
+
+SCENARIOS = ["create_xml_file", "create_xml_file_adapted", "epg_scheduler", "playlist", "playlist_all", "watch", "epg_xml",
+             "refresh_latency", "refresh_latency_inprocess"]
+
+def start_fake_server(args):
+    command = [sys.executable, os.path.join(BENCHMARK_DIR, "fake_pluto.py"), "--port", "0",
+               "--channels", str(args.channels), "--latency", str(args.latency),
+               "--latency-per-channel", str(args.latency_per_channel), "--overlap", str(args.overlap)]
+    if args.record_dir:
+        command += ["--record-dir", args.record_dir]
+    command += ["--error-rate", str(args.error_rate), "--tail-rate", str(args.tail_rate), "--tail-latency", str(args.tail_latency)]
+    server = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    # First line announces the bound address
+    line = server.stdout.readline()
+    return server, line.strip().rsplit(" ", 1)[-1]
+
+def run_child(name, args, api_url, work_dir, extra_env={}):
+    env = dict(os.environ, PLUTO_BOOT_URL=api_url, PLUTO_API_URL=api_url, PLUTO_CODE=args.countries, **extra_env)
+    if name.endswith("_inprocess"):
+        env["PLUTO_EPG_PROCESS"] = "0"
+    command = [sys.executable, os.path.abspath(__file__), "--child", name, "--api-url", api_url,
+               "--requests", str(args.requests), "--concurrency", str(args.concurrency)]
+    completed = subprocess.run(command, cwd=work_dir, env=env, capture_output=True, text=True)
+    for line in reversed(completed.stdout.splitlines()):
+        if line.startswith(RESULT_PREFIX):
+            return json.loads(line[len(RESULT_PREFIX):])
+    return {"error": (completed.stderr or completed.stdout).strip().splitlines()[-1:]}
+
+def print_table(results):
+    print(f"{'scenario':<26} {'wall s':>9} {'peak RSS MB':>12} {'req/s':>10} {'p99 ms':>9} {'upstream':>9}")
+    for name, result in results.items():
+        if "error" in result:
+            print(f"{name:<26} ERROR {result['error']}")
+            continue
+        rate = f"{result['requests_per_sec']:.0f}" if "requests_per_sec" in result else "-"
+        p99 = f"{result['p99_ms']:.1f}" if "p99_ms" in result else "-"
+        print(f"{name:<26} {result['wall_sec']:>9.2f} {result['peak_rss_mb']:>12.1f} {rate:>10} {p99:>9} {result['upstream_requests']:>9}")
+
+def sweep(args, api_url):
+    # create_xml_file with each fixed batch plan, then with the adaptive planner
+    results = {}
+    for group in args.sweep_groups:
+        for window in args.sweep_windows:
+            env = {"PLUTO_EPG_GROUP_MIN": str(group), "PLUTO_EPG_GROUP_MAX": str(group),
+                   "PLUTO_EPG_WINDOW_MIN": str(window), "PLUTO_EPG_WINDOW_MAX": str(window)}
+            with tempfile.TemporaryDirectory() as work_dir:
+                results[f"{group} x {window} min"] = run_child("create_xml_file", args, api_url, work_dir, env)
+    with tempfile.TemporaryDirectory() as work_dir:
+        results["adaptive"] = run_child("create_xml_file_adapted", args, api_url, work_dir)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end benchmarks against a local Pluto stand-in")
+    parser.add_argument("--scenario", action="append", choices=SCENARIOS, help="scenario to run (repeatable, default all)")
+    parser.add_argument("--countries", default="local,us_east,us_west,ca,uk,fr", help="PLUTO_CODE for the run")
+    parser.add_argument("--channels", type=int, default=400, help="channels per country")
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds of latency per upstream response")
+    parser.add_argument("--latency-per-channel", type=float, default=0.0, help="extra timelines latency per channel")
+    parser.add_argument("--overlap", type=float, default=0.75, help="share of channels countries have in common")
+    parser.add_argument("--record-dir", help="serve recorded JSON fixtures from this directory")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of timelines requests that fail with a 503")
+    parser.add_argument("--tail-rate", type=float, default=0.0, help="share of timelines requests delayed by --tail-latency")
+    parser.add_argument("--tail-latency", type=float, default=0.0, help="seconds added to a delayed timelines request")
+    parser.add_argument("--requests", type=int, default=500, help="requests per route scenario")
+    parser.add_argument("--concurrency", type=int, default=8, help="concurrent HTTP clients in refresh_latency")
+    parser.add_argument("--sweep", action="store_true", help="time create_xml_file across batch plans instead of running scenarios")
+    parser.add_argument("--sweep-groups", type=int, nargs="+", default=[25, 50, 100, 200], help="channels per request to sweep")
+    parser.add_argument("--sweep-windows", type=int, nargs="+", default=[180, 360, 720], help="minutes per request to sweep")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--api-url", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        result = run_scenario(args.child, args)
+        print(RESULT_PREFIX + json.dumps(result), flush=True)
+        return
+
+    server, api_url = start_fake_server(args)
+    results = {}
+    try:
+        if args.sweep:
+            results = sweep(args, api_url)
+        for name in [] if args.sweep else args.scenario or SCENARIOS:
+            # Every scenario starts from an empty working directory and a cold Client
+            with tempfile.TemporaryDirectory() as work_dir:
+                results[name] = run_child(name, args, api_url, work_dir)
+    finally:
+        server.terminate()
+        server.wait()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_table(results)
+
+if __name__ == "__main__":
+    main()
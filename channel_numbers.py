@@ -0,0 +1,106 @@
+import json, os, time
+from threading import Lock
+
+# Channel number allocation for playlists and guides.
+# Every channel in a scope (a country code, or "all") gets a unique number as close to the
+# one Pluto suggests as possible. Results are deterministic for the same input and are
+# persisted, so a channel keeps its number between refreshes and restarts for as long as
+# Pluto keeps suggesting the same one. A channel that leaves the lineup keeps its number
+# reserved for `retention` seconds in case it returns, then its entry is dropped.
+
+
+class ChannelNumbers:
+    def __init__(self, path=None, retention=7 * 24 * 3600):
+        self.path = path
+        self.retention = retention
+        self.lock = Lock()
+        # scope -> channel id -> [preferred number, assigned number], plus the time it went missing for absent channels
+        self.assigned = self.load()
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                return json.load(f)
+        except Exception as e:
+            print(f"[WARNING] Ignoring unreadable channel number file {self.path}: {e}")
+            return {}
+
+    def save(self):
+        if not self.path:
+            return
+        temp_path = f"{self.path}.tmp"
+        try:
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump(self.assigned, f, separators=(",", ":"))
+            os.replace(temp_path, self.path)
+        except Exception as e:
+            print(f"[WARNING] Unable to save channel numbers to {self.path}: {e}")
+
+    def assign(self, scope, channels):
+        # channels is an iterable of (channel id, preferred number); returns {channel id: number}
+        preferred = {}
+        for channel_id, number in channels:
+            preferred.setdefault(channel_id, number if isinstance(number, int) else 0)
+
+        with self.lock:
+            previous = self.assigned.get(scope, {})
+            numbers = {}
+            taken = NextFree()
+
+            # Channels whose suggested number is unchanged keep the number they had before
+            kept = sorted((previous[channel_id][1], channel_id) for channel_id, number in preferred.items()
+                          if channel_id in previous and previous[channel_id][0] == number)
+            for number, channel_id in kept:
+                if taken.claim(number):
+                    numbers[channel_id] = number
+
+            # Channels missing from this lineup hold on to their numbers until they expire
+            now = int(time.time())
+            missing = {}
+            for channel_id, entry in previous.items():
+                if channel_id in preferred:
+                    continue
+                missing_since = entry[2] if len(entry) > 2 else now
+                if now - missing_since < self.retention:
+                    missing[channel_id] = [entry[0], entry[1], missing_since]
+                    taken.claim(entry[1])
+
+            # Everything else takes the first free number at or above its suggestion
+            for number, channel_id in sorted((number, channel_id) for channel_id, number in preferred.items() if channel_id not in numbers):
+                numbers[channel_id] = taken.next(number)
+
+            updated = missing
+            updated.update({channel_id: [preferred[channel_id], number] for channel_id, number in numbers.items()})
+            if updated != previous:
+                self.assigned[scope] = updated
+                self.save()
+        return numbers
+
+
+class NextFree:
+    # Set of used numbers that finds the first free number at or above any value in near constant time
+    def __init__(self):
+        self.parent = {}
+
+    def find(self, number):
+        path = []
+        while number in self.parent:
+            path.append(number)
+            number = self.parent[number]
+        # Path compression: every number visited now points straight at the free one
+        for visited in path:
+            self.parent[visited] = number
+        return number
+
+    def claim(self, number):
+        if number in self.parent:
+            return False
+        self.parent[number] = number + 1
+        return True
+
+    def next(self, number):
+        number = self.find(number)
+        self.parent[number] = number + 1
+        return number
@@ -0,0 +1,104 @@
+import os, pickle, struct, subprocess, sys
+from threading import Lock
+
+# EPG files are rendered and compressed in a long-running child process so the
+# CPU-heavy work never runs on the server's gevent loop. The child keeps its own
+# Client, so the programme cache survives between builds.
+#
+# Messages are pickled dicts, each prefixed with its length, over the child's stdin/stdout.
+
+HEADER = struct.Struct(">Q")
+
+
+def send(stream, message):
+    data = pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL)
+    stream.write(HEADER.pack(len(data)))
+    stream.write(data)
+    stream.flush()
+
+def read_exact(stream, size):
+    chunks = []
+    while size:
+        chunk = stream.read(size)
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+def receive(stream):
+    header = read_exact(stream, HEADER.size)
+    if header is None:
+        return None
+    data = read_exact(stream, HEADER.unpack(header)[0])
+    if data is None:
+        return None
+    return pickle.loads(data)
+
+
+class EPGWorker:
+    def __init__(self):
+        self.process = None
+        self.lock = Lock()
+
+    def start(self):
+        self.process = subprocess.Popen([sys.executable, os.path.abspath(__file__)],
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        print(f"[INFO] Started EPG worker process {self.process.pid}")
+
+    def stop(self):
+        if self.process is None:
+            return
+        try:
+            self.process.kill()
+            self.process.wait()
+        except Exception:
+            pass
+        self.process = None
+
+    def call(self, message):
+        # One job at a time; a worker that died or broke the protocol is replaced on the next call
+        with self.lock:
+            if self.process is None or self.process.poll() is not None:
+                self.start()
+            try:
+                send(self.process.stdin, message)
+                reply = receive(self.process.stdout)
+            except Exception:
+                self.stop()
+                raise
+            if reply is None:
+                self.stop()
+                raise RuntimeError("EPG worker exited")
+            if reply.get("error"):
+                raise RuntimeError(reply["error"])
+            return reply["result"]
+
+    def write_xml_file(self, xml_file_path, station_list, program_data):
+        return self.call({"xml_file_path": os.path.abspath(xml_file_path),
+                          "station_list": station_list,
+                          "program_data": program_data})
+
+
+def main():
+    # Protocol messages use the original stdout; anything printed goes to stderr instead
+    protocol_in = sys.stdin.buffer
+    protocol_out = os.fdopen(os.dup(sys.stdout.fileno()), "wb")
+    sys.stdout = sys.stderr
+
+    os.environ["PLUTO_EPG_PROCESS"] = "0"
+    import pluto
+    client = pluto.Client()
+
+    while True:
+        message = receive(protocol_in)
+        if message is None:
+            return
+        try:
+            result = client.write_xml_file(message["xml_file_path"], message["station_list"], message["program_data"])
+            send(protocol_out, {"result": result})
+        except Exception as e:
+            send(protocol_out, {"error": f"{type(e).__name__}: {e}"})
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+import math
+from collections import deque
+from threading import Lock
+
+# Chooses how timelines requests are batched: channels per request (group size) and minutes per
+# request (window). Each response is recorded with its latency and size, and latency is modelled as
+# a fixed overhead plus a cost per channel-minute. The plan is the one with the shortest estimated
+# refresh for the worker pool, among those whose responses are expected to stay under the latency
+# and size limits. Until enough responses have been seen, the largest batch within the bounds is used.
+
+
+class BatchPlanner:
+    def __init__(self, group_bounds=(10, 100), window_bounds=(120, 720), workers=8,
+                 latency_limit=10.0, size_limit=8 * 1024 * 1024, history=100, min_samples=5):
+        self.group_bounds = group_bounds
+        self.window_bounds = window_bounds
+        self.workers = workers
+        self.latency_limit = latency_limit
+        self.size_limit = size_limit
+        self.min_samples = min_samples
+        # (channel-minutes, seconds, bytes) of recent responses
+        self.samples = deque(maxlen=history)
+        self.lock = Lock()
+
+    def observe(self, channels, minutes, seconds, size):
+        with self.lock:
+            self.samples.append((channels * minutes, seconds, size))
+
+    def model(self):
+        # Least squares fit of seconds = overhead + rate * channel-minutes, and the bytes per channel-minute
+        with self.lock:
+            samples = list(self.samples)
+        if len(samples) < self.min_samples:
+            return None
+        count = len(samples)
+        mean_x = sum(x for x, _, _ in samples) / count
+        mean_y = sum(y for _, y, _ in samples) / count
+        variance = sum((x - mean_x) ** 2 for x, _, _ in samples)
+        if variance:
+            rate = max(sum((x - mean_x) * (y - mean_y) for x, y, _ in samples) / variance, 0.0)
+            overhead = max(mean_y - rate * mean_x, 0.0)
+        else:
+            # Every response covered the same work, so there is no telling overhead from rate; assume all overhead
+            overhead, rate = mean_y, 0.0
+        size_rate = sum(size for _, _, size in samples) / max(sum(x for x, _, _ in samples), 1)
+        return overhead, rate, size_rate
+
+    def candidates(self, bounds, step):
+        # Both bounds and the doublings in between, as multiples of step
+        low, high = bounds
+        values = {low, high}
+        value = low
+        while value < high:
+            values.add(value)
+            value *= 2
+        return sorted({max(step, value // step * step) for value in values})
+
+    def plan(self, channel_count, span_minutes):
+        # Returns (group size, window minutes, estimated seconds or None)
+        model = self.model()
+        if model is None or not channel_count or not span_minutes:
+            return self.group_bounds[1], self.window_bounds[1], None
+        overhead, rate, size_rate = model
+
+        plans = []
+        for group in self.candidates(self.group_bounds, 1):
+            for window in self.candidates(self.window_bounds, 60):
+                work = min(group, channel_count) * min(window, span_minutes)
+                latency = overhead + rate * work
+                requests = math.ceil(channel_count / group) * math.ceil(span_minutes / window)
+                fits = latency <= self.latency_limit and size_rate * work <= self.size_limit
+                plans.append((fits, math.ceil(requests / self.workers) * latency, requests, work, group, window))
+
+        # The fastest plan that fits the limits (ties go to fewer requests); failing that, the smallest responses
+        fitting = [plan for plan in plans if plan[0]]
+        if fitting:
+            _, estimate, _, _, group, window = min(fitting, key=lambda plan: (round(plan[1], 3), plan[2]))
+        else:
+            _, estimate, _, _, group, window = min(plans, key=lambda plan: plan[3])
+        return group, window, estimate
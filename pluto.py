@@ -1,15 +1,368 @@
-import uuid, requests, json, pytz, gzip, re
+import uuid, requests, json, pytz, re, os, sys, time, random, gzip, pickle, queue, xmltv, epg_worker, channel_numbers, metrics, resilience, planner
+from concurrent.futures import ThreadPoolExecutor
+from bisect import bisect_left, bisect_right
+from functools import lru_cache
+from threading import Thread, Lock, Event
 from datetime import datetime, timedelta
-import xml.etree.ElementTree as ET
+
+# Maximum number of timeline requests in flight at once.
+# Fallback to default if invalid or unspecified
+try:
+    EPG_FETCH_WORKERS = max(1, int(os.environ.get("PLUTO_EPG_WORKERS", 8)))
+except:
+    EPG_FETCH_WORKERS = 8
+
+# Pluto endpoints, overridable to run against a local stand-in (see benchmarks/fake_pluto.py)
+BOOT_URL = os.environ.get("PLUTO_BOOT_URL", "https://boot.pluto.tv").rstrip('/')
+API_URL = os.environ.get("PLUTO_API_URL", "https://service-channels.clusters.pluto.tv").rstrip('/')
+
+# Boot responses are renewed proactively TOKEN_REFRESH_MARGIN plus a random jitter before they expire
+TOKEN_LIFETIME = timedelta(hours=4)
+TOKEN_REFRESH_MARGIN = timedelta(minutes=30)
+TOKEN_REFRESH_JITTER = timedelta(minutes=15)
+TOKEN_REFRESH_RETRY = timedelta(minutes=1)
+
+# Hours from now that are retrieved again on every refresh to pick up late schedule changes
+try:
+    EPG_REVALIDATE_HOURS = max(0, int(os.environ.get("PLUTO_EPG_REVALIDATE_HOURS", 2)))
+except:
+    EPG_REVALIDATE_HOURS = 2
+
+# Build EPG files in a separate worker process (0 builds them inside the server process)
+EPG_PROCESS = os.environ.get("PLUTO_EPG_PROCESS", "1") != "0"
+
+# gzip level of the compressed EPG files, and the threads compressing their blocks in parallel.
+# By default one thread per CPU this process may run on, up to 4: cpu_count() is the host's count inside
+# a container, and each thread keeps up to two 1 MB blocks in memory.
+try:
+    GZIP_LEVEL = min(9, max(1, int(os.environ.get("PLUTO_GZIP_LEVEL", 9))))
+except:
+    GZIP_LEVEL = 9
+DEFAULT_GZIP_THREADS = min(4, len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1)
+try:
+    GZIP_THREADS = max(1, int(os.environ.get("PLUTO_GZIP_THREADS", DEFAULT_GZIP_THREADS)))
+except:
+    GZIP_THREADS = DEFAULT_GZIP_THREADS
+
+# Connections kept open to each Pluto host. Requests beyond this wait for a free connection,
+# which caps how hard a refresh of every country at once can hit a single host
+try:
+    HTTP_POOL_SIZE = max(1, int(os.environ.get("PLUTO_HTTP_POOL_SIZE", 16)))
+except:
+    HTTP_POOL_SIZE = 16
+
+# Seconds to wait for a connection to Pluto and for each read of a response
+try:
+    HTTP_TIMEOUT = (float(os.environ.get("PLUTO_HTTP_CONNECT_TIMEOUT", 5)), float(os.environ.get("PLUTO_HTTP_READ_TIMEOUT", 30)))
+except:
+    HTTP_TIMEOUT = (5.0, 30.0)
+
+# Bounds for the channels per timelines request and the minutes each request covers.
+# Within them the batch planner picks the fastest plan from observed latencies and response sizes.
+try:
+    EPG_GROUP_BOUNDS = (max(1, int(os.environ.get("PLUTO_EPG_GROUP_MIN", 10))), max(1, int(os.environ.get("PLUTO_EPG_GROUP_MAX", 100))))
+except:
+    EPG_GROUP_BOUNDS = (10, 100)
+try:
+    EPG_WINDOW_BOUNDS = (max(60, int(os.environ.get("PLUTO_EPG_WINDOW_MIN", 120))), max(60, int(os.environ.get("PLUTO_EPG_WINDOW_MAX", 720))))
+except:
+    EPG_WINDOW_BOUNDS = (120, 720)
+
+# Attempts after the first for idempotent guide requests that fail or return 429/5xx, with exponential backoff
+try:
+    HTTP_RETRIES = max(0, int(os.environ.get("PLUTO_HTTP_RETRIES", 2)))
+except:
+    HTTP_RETRIES = 2
+HTTP_RETRY_BACKOFF = 0.5
+RETRIED_ENDPOINTS = ("channels", "categories", "timelines")
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+# Timelines requests still running at the endpoint's 95th percentile latency are sent a second time,
+# and whichever response arrives first is used
+HEDGED_ENDPOINTS = ("timelines",)
+HEDGE_PERCENTILE = 0.95
+
+# Consecutive failures that open an endpoint's circuit, and seconds before it is tried again.
+# While it is open requests fail fast and the last good data keeps being served.
+CIRCUIT_FAILURES = 5
+CIRCUIT_RESET_SECONDS = 30
+
+# Longest a country's guide build waits for channels another country is fetching
+EPG_CLAIM_TIMEOUT = 300
+
+# Seconds a country's channel list is served from memory before it is refreshed in the background
+try:
+    CHANNEL_TTL = max(0, int(os.environ.get("PLUTO_CHANNEL_TTL", 3600)))
+except:
+    CHANNEL_TTL = 3600
+
+# File the assigned channel numbers are kept in so they survive restarts (empty keeps them in memory only)
+CHANNEL_NUMBERS_FILE = os.environ.get("PLUTO_CHANNEL_NUMBERS_FILE", "channel-numbers.json")
+
+# Snapshot of tokens, channel lists and stored guide data, loaded on first use after a restart (empty disables it)
+CACHE_FILE = os.environ.get("PLUTO_CACHE_FILE", "pluto-cache.pkl.gz")
+CACHE_VERSION = 1
+
+# Added to channel numbers in the combined "all" list so each country keeps its own range
+COUNTRY_NUMBER_OFFSETS = {"ca": 6000, "uk": 7000, "fr": 8000}
+
+# Metrics served at /metrics
+UPSTREAM_SECONDS = metrics.histogram("pluto_upstream_request_seconds", "Latency of requests to the Pluto APIs", ("endpoint", "country"))
+UPSTREAM_ERRORS = metrics.counter("pluto_upstream_errors_total", "Requests to the Pluto APIs that failed or returned an error status", ("endpoint", "country"))
+EPG_PHASE_SECONDS = metrics.histogram("pluto_epg_phase_seconds", "Time spent in each phase of an EPG build", ("phase", "target"),
+                                      buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0))
+PROGRAMME_CACHE_LOOKUPS = metrics.counter("pluto_programme_cache_lookups_total", "Programme fragment cache lookups", ("result",))
+PROGRAMME_CACHE_ENTRIES = metrics.gauge("pluto_programme_cache_entries", "Programme fragments held in the cache")
+TOKEN_AGE = metrics.gauge("pluto_token_age_seconds", "Age of each country's boot token", ("country",))
+UPSTREAM_RETRIES = metrics.counter("pluto_upstream_retries_total", "Requests to the Pluto APIs that were retried", ("endpoint", "country"))
+UPSTREAM_HEDGES = metrics.counter("pluto_upstream_hedges_total", "Slow requests to the Pluto APIs that were sent a second time", ("endpoint", "country"))
+CIRCUIT_OPEN = metrics.gauge("pluto_upstream_circuit_open", "1 while requests to a Pluto endpoint are failing fast", ("endpoint",))
+EPG_ARTIFACT_BYTES = metrics.gauge("pluto_epg_artifact_bytes", "Size of each EPG file written by the last build", ("file",))
+EPG_COMPRESSION_RATIO = metrics.gauge("pluto_epg_compression_ratio", "Uncompressed over compressed size of each EPG file", ("file",))
+EPG_COMPRESS_THROUGHPUT = metrics.gauge("pluto_epg_compress_bytes_per_cpu_second", "Uncompressed bytes compressed per CPU second in the last build", ("file",))
+
+# XMLTV categories for each Pluto genre
+SERIES_GENRES = {
+    ("Animated",): ["Family Animation", "Cartoons"],
+    ("Educational",): ["Education & Guidance", "Instructional & Educational"],
+    ("News",): ["News and Information", "General News", "News + Opinion", "General News"],
+    ("History",): ["History & Social Studies"],
+    ("Politics",): ["Politics"],
+    ("Action",):
+        [
+          "Action & Adventure",
+          "Action Classics",
+          "Martial Arts",
+          "Crime Action",
+          "Family Adventures",
+          "Action Sci-Fi & Fantasy",
+          "Action Thrillers",
+          "African-American Action",
+        ],
+    ("Adventure",): ["Action & Adventure", "Adventures", "Sci-Fi Adventure"],
+    ("Reality",):
+        [
+          "Reality",
+          "Reality Drama",
+          "Courtroom Reality",
+          "Occupational Reality",
+          "Celebrity Reality",
+        ],
+    ("Documentary",):
+        [
+          "Documentaries",
+          "Social & Cultural Documentaries",
+          "Science and Nature Documentaries",
+          "Miscellaneous Documentaries",
+          "Crime Documentaries",
+          "Travel & Adventure Documentaries",
+          "Sports Documentaries",
+          "Military Documentaries",
+          "Political Documentaries",
+          "Foreign Documentaries",
+          "Religion & Mythology Documentaries",
+          "Historical Documentaries",
+          "Biographical Documentaries",
+          "Faith & Spirituality Documentaries",
+        ],
+    ("Biography",): ["Biographical Documentaries", "Inspirational Biographies"],
+    ("Science Fiction",): ["Sci-Fi Thrillers", "Sci-Fi Adventure", "Action Sci-Fi & Fantasy"],
+    ("Thriller",): ["Sci-Fi Thrillers", "Thrillers", "Crime Thrillers"],
+    ("Biography",): ["Biographical Documentaries", "Inspirational Biographies"],
+    ("Talk",): ["Talk & Variety", "Talk Show"],
+    ("Variety",): ["Sketch Comedies"],
+    ("Home Improvement",): ["Art & Design", "DIY & How To", "Home Improvement"],
+    ("House/garden",): ["Home & Garden"],
+    # ("Science",): ["Science and Nature Documentaries"],
+    # ("Nature",): ["Science and Nature Documentaries", "Animals"],
+    ("Cooking",): ["Cooking Instruction", "Food & Wine", "Food Stories"],
+    ("Travel",): ["Travel & Adventure Documentaries", "Travel"],
+    ("Western",): ["Westerns", "Classic Westerns"],
+    ("LGBTQ",): ["Gay & Lesbian", "Gay & Lesbian Dramas", "Gay"],
+    ("Game show",): ["Game Show"],
+    ("Military",): ["Classic War Stories"],
+    ("Comedy",):
+        [
+          "Cult Comedies",
+          "Spoofs and Satire",
+          "Slapstick",
+          "Classic Comedies",
+          "Stand-Up",
+          "Sports Comedies",
+          "African-American Comedies",
+          "Showbiz Comedies",
+          "Sketch Comedies",
+          "Teen Comedies",
+          "Latino Comedies",
+          "Family Comedies",
+        ],
+    ("Crime",): ["Crime Action", "Crime Drama", "Crime Documentaries"],
+    ("Sports",): ["Sports","Sports & Sports Highlights","Sports Documentaries", "Poker & Gambling"],
+    ("Poker & Gambling",): ["Poker & Gambling"],
+    ("Crime drama",): ["Crime Drama"],
+    ("Drama",):
+        [
+          "Classic Dramas",
+          "Family Drama",
+          "Indie Drama",
+          "Romantic Drama",
+          "Crime Drama",
+        ],
+    ("Children",): ["Kids", "Children & Family", "Kids' TV", "Cartoons", "Animals", "Family Animation", "Ages 2-4", "Ages 11-12",],
+    ("Animated",): ["Family Animation", "Cartoons"]
+    }
+
+def build_genre_index(series_genres):
+    # Reverse index from Pluto genre to every XMLTV category that lists it, in SERIES_GENRES order
+    index = {}
+    for categories, genres in series_genres.items():
+        for genre in dict.fromkeys(genres):
+            index.setdefault(genre, []).extend(categories)
+    return index
+
+GENRE_CATEGORIES = build_genre_index(SERIES_GENRES)
+
+ILLEGAL_CHAR_PATTERN = re.compile(r'[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+def genre_categories(genre):
+    # Genres without a mapping are used as the category as is
+    return GENRE_CATEGORIES.get(genre) or [genre]
+
+@lru_cache(maxsize=16384)
+def xmltv_time(timestamp):
+    # Pluto ISO-8601 timestamp to XMLTV start/stop format
+    return datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%S.%fZ").replace(tzinfo=pytz.utc).strftime("%Y%m%d%H%M%S %z")
+
+@lru_cache(maxsize=16384)
+def air_date(timestamp):
+    # Pluto ISO-8601 release date to the (original-air-date, date) pair used in a programme
+    release_date = datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%S.%fZ")
+    return release_date.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + 'Z', release_date.strftime("%Y%m%d")
+
+class Programme:
+    # Compact form of a /v2/guide/timelines entry holding only the fields read_epg_data uses.
+    # Strings that repeat across programmes and channels are interned so they are stored once.
+    __slots__ = ("start", "stop", "title", "episode_id", "name", "description", "season", "number",
+                 "series_type", "series_id", "tile", "release_date", "genre", "sub_genre")
+
+    def __init__(self, start, stop, title, episode_id, name, description, season, number,
+                 series_type, series_id, tile, release_date, genre, sub_genre):
+        self.start = start
+        self.stop = stop
+        self.title = title
+        self.episode_id = episode_id
+        self.name = name
+        self.description = description
+        self.season = season
+        self.number = number
+        self.series_type = series_type
+        self.series_id = series_id
+        self.tile = tile
+        self.release_date = release_date
+        self.genre = genre
+        self.sub_genre = sub_genre
+
+    @classmethod
+    def from_timeline(cls, timeline):
+        episode = timeline["episode"]
+        series = episode.get("series", {})
+        return cls(intern(timeline["start"]), intern(timeline["stop"]), intern(timeline["title"]),
+                   episode["_id"], intern(episode["name"]), episode["description"],
+                   episode.get("season"), episode.get("number"),
+                   intern(series.get("type", "")), intern(series["_id"]), intern(series["tile"]["path"]),
+                   intern(episode["clip"]["originalReleaseDate"]), intern(episode.get("genre")), intern(episode.get("subGenre")))
+
+    def as_dict(self):
+        # Same layout as the upstream timeline, limited to the stored fields
+        return {"start": self.start, "stop": self.stop, "title": self.title,
+                "episode": {"_id": self.episode_id, "name": self.name, "description": self.description,
+                            "season": self.season, "number": self.number,
+                            "genre": self.genre, "subGenre": self.sub_genre,
+                            "clip": {"originalReleaseDate": self.release_date},
+                            "series": {"_id": self.series_id, "type": self.series_type, "tile": {"path": self.tile}}}}
+
+def guide_time(value=None):
+    # A datetime or ISO 8601 string (default now) in the timestamp layout of stored programmes
+    if value is None:
+        value = datetime.now(pytz.utc)
+    elif isinstance(value, str):
+        value = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if value.tzinfo is None:
+        value = pytz.utc.localize(value)
+    return value.astimezone(pytz.utc).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+def gzip_threads():
+    # With gevent monkey patching (a build inside the server process) threads are greenlets,
+    # so blocks would only be compressed one after another on the event loop
+    monkey = sys.modules.get("gevent.monkey")
+    if monkey is not None and monkey.is_module_patched("threading"):
+        return 1
+    return GZIP_THREADS
+
+def intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+class SingleFlight:
+    # Concurrent calls with the same key wait for the call already in flight and share its result
+    def __init__(self):
+        self.lock = Lock()
+        self.calls = {}
+
+    def do(self, key, func, *args):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = {"done": Event(), "result": None, "error": None}
+                self.calls[key] = call
+
+        if not leader:
+            call["done"].wait()
+            if call["error"] is not None:
+                raise call["error"]
+            return call["result"]
+
+        try:
+            call["result"] = func(*args)
+            return call["result"]
+        except BaseException as e:
+            call["error"] = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call["done"].set()
 
 class Client:
     def __init__(self):
-        self.session = requests.Session()
+        self.session = self.create_session()
+        self.breakers = {}
+        self.latency = {}
         self.sessionAt = {}
+        self.tokenRefreshAt = {}
         self.response_list = {}
-        self.epg_data = {}
+        self.epg_store = {}
+        self.epg_claims = {}
+        self.epg_claims_lock = Lock()
+        self.planners = {}
+        self.guide_starts = {}
+        self.guide_channels = {}
         self.device = None
         self.all_channels = {}
+        self.channelsAt = {}
+        self.channels_refreshing = set()
+        self.channel_ttl = CHANNEL_TTL
+        self.channel_numbers = channel_numbers.ChannelNumbers(CHANNEL_NUMBERS_FILE)
+        self.epg_workers = EPG_FETCH_WORKERS
+        self.programme_cache = xmltv.ProgrammeCache()
+        self.cache_stats = {"hits": 0, "misses": 0, "entries": 0}
+        self.epg_worker = epg_worker.EPGWorker() if EPG_PROCESS else None
+        self.singleflight = SingleFlight()
+        self.cache_file = CACHE_FILE
+        self.snapshot_lock = Lock()
+        self.snapshot_loaded = False
+        TOKEN_AGE.set_function(self.token_ages)
+        CIRCUIT_OPEN.set_function(lambda: {(endpoint,): int(breaker.is_open()) for endpoint, breaker in list(self.breakers.items())})
 
         self.load_device()
         self.x_forward = {"local": {"X-Forwarded-For":""},
@@ -19,17 +372,156 @@ class Client:
                           "us_east": {"X-Forwarded-For":"108.82.206.181"},
                           "us_west": {"X-Forwarded-For":"76.81.9.69"},}
 
+    def create_session(self):
+        # Keep-alive connections are pooled per host; pool_block makes HTTP_POOL_SIZE a hard cap per host
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE, pool_block=True)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
     def load_device(self):
         if self.device is None:
             self.device = uuid.uuid1()
         return(self.device)
 
+    def load_snapshot(self):
+        # Restores the state saved by save_snapshot so a restarted server answers from it straight away;
+        # stale entries are then refreshed by the usual TTLs and the scheduler
+        if self.snapshot_loaded:
+            return
+        with self.snapshot_lock:
+            if self.snapshot_loaded:
+                return
+            self.snapshot_loaded = True
+            if not self.cache_file or not os.path.exists(self.cache_file):
+                return
+            try:
+                with gzip.open(self.cache_file, "rb") as f:
+                    snapshot = pickle.load(f)
+                if snapshot.get("version") != CACHE_VERSION:
+                    print(f"[INFO] Ignoring cache file {self.cache_file} from another version")
+                    return
+            except Exception as e:
+                print(f"[WARNING] Ignoring unreadable cache file {self.cache_file}: {e}")
+                return
+
+            # Anything fetched before the snapshot finished loading is newer, so it is kept
+            for name in ("response_list", "sessionAt", "tokenRefreshAt", "all_channels", "channelsAt", "epg_store"):
+                restored = snapshot.get(name, {})
+                restored.update(getattr(self, name))
+                setattr(self, name, restored)
+            print(f"[INFO] Loaded cache file {self.cache_file}: {len(self.all_channels)} channel lists, {len(self.epg_store)} channel guides")
+
+    def save_snapshot(self):
+        if not self.cache_file:
+            return
+        self.load_snapshot()
+        snapshot = {"version": CACHE_VERSION,
+                    "response_list": dict(self.response_list),
+                    "sessionAt": dict(self.sessionAt),
+                    "tokenRefreshAt": dict(self.tokenRefreshAt),
+                    "all_channels": dict(self.all_channels),
+                    "channelsAt": dict(self.channelsAt),
+                    "epg_store": dict(self.epg_store)}
+        temp_path = f"{self.cache_file}.tmp"
+        try:
+            # Fast compression: the snapshot is rewritten after every scheduler pass
+            with gzip.open(temp_path, "wb", compresslevel=1) as f:
+                pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, self.cache_file)
+        except Exception as e:
+            print(f"[WARNING] Unable to save cache file {self.cache_file}: {e}")
+
+    def upstream_get(self, endpoint, country_code, url, **kwargs):
+        # Every request to Pluto goes through here: timeouts, retries, hedging and the endpoint's circuit breaker.
+        # requests asks for gzip'd responses and decodes them itself
+        kwargs.setdefault('timeout', HTTP_TIMEOUT)
+        breaker = self.breakers.setdefault(endpoint, resilience.CircuitBreaker(CIRCUIT_FAILURES, CIRCUIT_RESET_SECONDS))
+        retries = HTTP_RETRIES if endpoint in RETRIED_ENDPOINTS else 0
+
+        for attempt in range(retries + 1):
+            if attempt:
+                UPSTREAM_RETRIES.inc(endpoint=endpoint, country=country_code)
+                time.sleep(HTTP_RETRY_BACKOFF * 2 ** (attempt - 1) * random.uniform(1, 1.5))
+            if not breaker.allow():
+                UPSTREAM_ERRORS.inc(endpoint=endpoint, country=country_code)
+                raise resilience.CircuitOpenError(f"Pluto {endpoint} requests are failing, circuit open")
+            try:
+                if endpoint in HEDGED_ENDPOINTS:
+                    response = self.hedged_get(endpoint, country_code, url, **kwargs)
+                else:
+                    response = self.timed_get(endpoint, country_code, url, **kwargs)
+            except Exception:
+                breaker.failure()
+                if attempt == retries: raise
+                continue
+            if response.status_code not in RETRY_STATUS_CODES:
+                breaker.success()
+                return response
+            breaker.failure()
+        return response
+
+    def timed_get(self, endpoint, country_code, url, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = self.session.get(url, **kwargs)
+        except Exception:
+            UPSTREAM_ERRORS.inc(endpoint=endpoint, country=country_code)
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            UPSTREAM_SECONDS.observe(elapsed, endpoint=endpoint, country=country_code)
+            self.latency.setdefault(endpoint, resilience.LatencyWindow()).add(elapsed)
+        if not (200 <= response.status_code < 300):
+            UPSTREAM_ERRORS.inc(endpoint=endpoint, country=country_code)
+        return response
+
+    def hedged_get(self, endpoint, country_code, url, **kwargs):
+        threshold = self.latency.setdefault(endpoint, resilience.LatencyWindow()).percentile(HEDGE_PERCENTILE)
+        if threshold is None:
+            return self.timed_get(endpoint, country_code, url, **kwargs)
+
+        results = queue.Queue()
+        def attempt():
+            try:
+                results.put((self.timed_get(endpoint, country_code, url, **kwargs), None))
+            except Exception as e:
+                results.put((None, e))
+
+        Thread(target=attempt, daemon=True).start()
+        outstanding = 1
+        try:
+            response, error = results.get(timeout=threshold)
+            outstanding -= 1
+        except queue.Empty:
+            # Still waiting at the usual worst case: send a duplicate, the slower response is discarded
+            UPSTREAM_HEDGES.inc(endpoint=endpoint, country=country_code)
+            Thread(target=attempt, daemon=True).start()
+            outstanding = 2
+            response, error = results.get()
+            outstanding -= 1
+        # A failure only counts once nothing else can still succeed
+        while (error is not None or response.status_code != 200) and outstanding:
+            response, error = results.get()
+            outstanding -= 1
+        if error is not None: raise error
+        return response
+
     def resp_data(self, country_code):
+        self.load_snapshot()
         desired_timezone = pytz.timezone('UTC')
         current_date = datetime.now(desired_timezone)
-        if (self.response_list.get(country_code) is not None) and (current_date - self.sessionAt.get(country_code, datetime.now())) < timedelta(hours=4):
+        if (self.response_list.get(country_code) is not None) and (current_date - self.sessionAt.get(country_code, datetime.now())) < TOKEN_LIFETIME:
             return self.response_list[country_code], None
 
+        # Callers arriving while a token is being generated share that boot request
+        return self.singleflight.do((country_code, 'boot'), self.fetch_boot, country_code)
+
+    def fetch_boot(self, country_code):
+        desired_timezone = pytz.timezone('UTC')
+        current_date = datetime.now(desired_timezone)
+
         boot_headers = {
             'authority': 'boot.pluto.tv',
             'accept': '*/*',
@@ -67,7 +559,7 @@ class Client:
             boot_headers.update(self.x_forward.get(country_code))
 
         try:
-            response = self.session.get('https://boot.pluto.tv/v4/start', headers=boot_headers, params=boot_params)
+            response = self.upstream_get('boot', country_code, f'{BOOT_URL}/v4/start', headers=boot_headers, params=boot_params)
         except Exception as e:
             return None, (f"Error Exception type: {type(e).__name__}")
 
@@ -80,21 +572,110 @@ class Client:
         # Save entire Response:
         self.response_list.update({country_code: resp})
         self.sessionAt.update({country_code: current_date})
+        # Jitter keeps the proactive refreshes of several countries from lining up
+        jitter = timedelta(seconds=random.uniform(0, TOKEN_REFRESH_JITTER.total_seconds()))
+        self.tokenRefreshAt.update({country_code: current_date + TOKEN_LIFETIME - TOKEN_REFRESH_MARGIN - jitter})
         print(f"New token for {country_code} generated at {(self.sessionAt.get(country_code)).strftime('%Y-%m-%d %H:%M.%S %z')}")
 
         return self.response_list.get(country_code), None
 
-    def channels(self, country_code):
+    def token_ages(self):
+        current_date = datetime.now(pytz.utc)
+        return {(country_code,): (current_date - generated_at).total_seconds() for country_code, generated_at in list(self.sessionAt.items())}
+
+    def token_status(self, country_code):
+        generated_at = self.sessionAt.get(country_code)
+        if generated_at is None:
+            return {'country_code': country_code, 'generated_at': None, 'age_seconds': None, 'next_refresh': None}
+        next_refresh = self.tokenRefreshAt.get(country_code)
+        return {'country_code': country_code,
+                'generated_at': generated_at.isoformat(),
+                'age_seconds': int((datetime.now(pytz.utc) - generated_at).total_seconds()),
+                'next_refresh': next_refresh.isoformat() if next_refresh else None}
+
+    def start_token_refresh(self, country_codes):
+        # Renew each country's boot response before it expires so requests never wait on boot.pluto.tv
+        Thread(target=self.token_refresh_loop, args=(list(country_codes),), daemon=True).start()
+
+    def token_refresh_loop(self, country_codes):
+        # Tokens restored from the snapshot are renewed when they are due, not straight after a restart
+        self.load_snapshot()
+        retry_at = {}
+        while True:
+            current_date = datetime.now(pytz.utc)
+            for country_code in country_codes:
+                due = max(self.tokenRefreshAt.get(country_code, current_date), retry_at.get(country_code, current_date))
+                if due > current_date:
+                    continue
+                try:
+                    resp, error = self.singleflight.do((country_code, 'boot'), self.fetch_boot, country_code)
+                except Exception as e:
+                    error = f"Error Exception type: {type(e).__name__}"
+                if error:
+                    print(f"[ERROR] Token refresh for {country_code} failed: {error}")
+                    retry_at.update({country_code: current_date + TOKEN_REFRESH_RETRY})
+                else:
+                    retry_at.pop(country_code, None)
+
+            # Sleep until the next token is due, waking at least once a minute
+            current_date = datetime.now(pytz.utc)
+            next_due = min((max(self.tokenRefreshAt.get(code, current_date), retry_at.get(code, current_date)) for code in country_codes), default=current_date + timedelta(minutes=1))
+            time.sleep(min(max((next_due - current_date).total_seconds(), 1), 60))
+
+    def channels(self, country_code, refresh=False):
+        self.load_snapshot()
         if country_code == 'all':
             return(self.channels_all())
 
+        stations = self.all_channels.get(country_code)
+        if stations is None:
+            return self.update_channels(country_code)
+        if refresh:
+            # While Pluto is failing the last good list is served
+            try:
+                fresh, error = self.update_channels(country_code)
+            except Exception as e:
+                fresh, error = None, f"Error Exception type: {type(e).__name__}"
+            if not error: return fresh, None
+            print(f"[WARNING] Channel refresh for {country_code} failed, using cached list: {error}")
+            return self.all_channels.get(country_code, stations), None
+
+        # Serve the cached list; once it is older than the TTL refresh it in the background
+        desired_timezone = pytz.timezone('UTC')
+        current_date = datetime.now(desired_timezone)
+        if (current_date - self.channelsAt.get(country_code, current_date)) >= timedelta(seconds=self.channel_ttl):
+            if country_code not in self.channels_refreshing:
+                self.channels_refreshing.add(country_code)
+                Thread(target=self.refresh_channels, args=(country_code,), daemon=True).start()
+
+        return(stations, None)
+
+    def channels_version(self, country_code):
+        # Changes whenever a channel list that makes up country_code is replaced
+        if country_code == 'all':
+            return tuple(sorted(self.channelsAt.items()))
+        return self.channelsAt.get(country_code)
+
+    def refresh_channels(self, country_code):
+        try:
+            stations, error = self.update_channels(country_code)
+            if error: print(f"[ERROR] Channel refresh for {country_code} failed, serving cached list: {error}")
+        except Exception as e:
+            print(f"[ERROR] Channel refresh for {country_code} failed, serving cached list: {e}")
+        finally:
+            self.channels_refreshing.discard(country_code)
+
+    def update_channels(self, country_code):
+        return self.singleflight.do((country_code, 'channels'), self.fetch_channels, country_code)
+
+    def fetch_channels(self, country_code):
         resp, error = self.resp_data(country_code)
         if error: return None, error
 
         token = resp.get('sessionToken', None)
         if token is None: return None, error
 
-        url = f"https://service-channels.clusters.pluto.tv/v2/guide/channels"
+        url = f"{API_URL}/v2/guide/channels"
 
         headers = {
             'authority': 'service-channels.clusters.pluto.tv',
@@ -116,7 +697,7 @@ class Client:
             headers.update(self.x_forward.get(country_code))
 
         try:
-            response = self.session.get(url, params=params, headers=headers)
+            response = self.upstream_get('channels', country_code, url, params=params, headers=headers)
         except Exception as e:
             return None, (f"Error Exception type: {type(e).__name__}")
 
@@ -125,10 +706,10 @@ class Client:
 
         channel_list = response.json().get("data")
 
-        category_url = f"https://service-channels.clusters.pluto.tv/v2/guide/categories"
+        category_url = f"{API_URL}/v2/guide/categories"
 
         try:
-            response = self.session.get(category_url, params=params, headers=headers)
+            response = self.upstream_get('categories', country_code, category_url, params=params, headers=headers)
         except Exception as e:
             return None, (f"Error Exception type: {type(e).__name__}")
         
@@ -154,26 +735,26 @@ class Client:
                     'group': categories_list.get(elem.get('id')),
                     'country_code': country_code}
 
-            # Ensure number value is unique
-            number = elem.get('number')
-            existing_numbers = {channel["number"] for channel in stations}
-            while number in existing_numbers:
-                # print(f"Updating channel number for {elem.get('name')}")
-                number += 1
-
             # Filter the list to find the element with "type" equal to "colorLogoPNG"
             color_logo_png = next((image["url"] for image in elem["images"] if image["type"] == "colorLogoPNG"), None)
-            entry.update({'number': number, 'logo': color_logo_png})
+            entry.update({'number': elem.get('number'), 'logo': color_logo_png})
 
             stations.append(entry)
 
+        # Ensure number value is unique
+        numbers = self.channel_numbers.assign(country_code, ((entry['id'], entry['number']) for entry in stations))
+        for entry in stations:
+            entry['number'] = numbers[entry['id']]
+
         sorted_data = sorted(stations, key=lambda x: x["number"])
         # print(json.dumps(sorted_data[0], indent = 2))
 
         self.all_channels.update({country_code: sorted_data})
+        self.channelsAt.update({country_code: datetime.now(pytz.utc)})
         return(sorted_data, None)
 
     def channels_all(self):
+        self.load_snapshot()
         all_channel_list = []
         for key, val in self.all_channels.items():
             all_channel_list.extend(val)
@@ -183,59 +764,59 @@ class Client:
         filter_key = 'id'
         filtered_list = [d for d in all_channel_list if d[filter_key] not in seen and not seen.add(d[filter_key])]
 
-
-        seen = set()
-        for elem in filtered_list:
-            # Ensure number value is unique
+        # Ensure number value is unique, on copies so the cached per-country lists keep their own numbers
+        def preferred(elem):
             number = elem.get('number')
-            match elem.get('country_code').lower():
-                case 'ca':
-                    offset = 6000
-                    if number < offset:
-                        number += offset
-                case 'uk':
-                    offset = 7000
-                    if number < offset:
-                        number += offset
-                case 'fr':
-                    offset = 8000
-                    if number < offset:
-                        number += offset
-            while number in seen:
-                number += 1
-            seen.add(number)
-            if number != elem.get('number'):
-                elem.update({'number': number})
-
-        return(filtered_list, None)
+            offset = COUNTRY_NUMBER_OFFSETS.get(elem.get('country_code').lower(), 0)
+            return number + offset if number < offset else number
+
+        numbers = self.channel_numbers.assign('all', ((elem['id'], preferred(elem)) for elem in filtered_list))
+        return([dict(elem, number=numbers[elem['id']]) for elem in filtered_list], None)
 
     #########################################################################################
     # EPG Guide Data
     #########################################################################################
     def strip_illegal_characters(self, xml_string):
-        # Define a regular expression pattern to match illegal characters
-        illegal_char_pattern = re.compile(r'[\x00-\x08\x0b\x0c\x0e-\x1f]')
-
         # Replace illegal characters with an empty string
-        clean_xml_string = illegal_char_pattern.sub('', xml_string)
-
-        return clean_xml_string
+        return ILLEGAL_CHAR_PATTERN.sub('', xml_string)
 
 
     def update_epg(self, country_code, range_count = 3):
+        # Returns (guide, error). The guide is handed to the caller instead of being kept on the client,
+        # so builds running at the same time never see another refresh replace or clear what they are writing.
+        return self.singleflight.do((country_code, 'epg'), self.fetch_epg, country_code, range_count)
+
+    def update_epg_many(self, country_codes, range_count = 3):
+        # Refreshes several countries' channel lists and guides at once; their requests share the per-host
+        # connection pools and channels they have in common are fetched once. Returns {country_code: error}.
+        def refresh(country_code):
+            station_list, error = self.channels(country_code, refresh=True)
+            if error: return error
+            guide, error = self.update_epg(country_code, range_count)
+            return error
+
+        with ThreadPoolExecutor(max_workers=max(1, len(country_codes))) as pool:
+            errors = list(pool.map(refresh, country_codes))
+        return {country_code: error for country_code, error in zip(country_codes, errors) if error}
+
+    def fetch_epg(self, country_code, range_count = 3):
         resp, error = self.resp_data(country_code)
         if error: return None, error
 
         token = resp.get('sessionToken', None)
-        if token is None: return None, error
+        if token is None: return None, f"No session token for {country_code}"
 
         desired_timezone = pytz.timezone('UTC')
 
-        start_datetime = datetime.now(desired_timezone)
+        current_date = datetime.now(desired_timezone)
+        now = current_date.strftime("%Y-%m-%dT%H:%M:%S.000Z")
+        start_datetime = current_date.replace(minute=0, second=0, microsecond=0)
         start_time = start_datetime.strftime("%Y-%m-%dT%H:00:00.000Z")
-        end_time = start_time
+        window = timedelta(minutes=720)
+        horizon_datetime = start_datetime + range_count * window
+        revalidate_end = min(start_datetime + timedelta(hours=EPG_REVALIDATE_HOURS), horizon_datetime)
 
-        url = f"https://service-channels.clusters.pluto.tv/v2/guide/timelines"
+        url = f"{API_URL}/v2/guide/timelines"
 
         epg_headers = {
             'authority': 'service-channels.clusters.pluto.tv',
@@ -246,251 +827,351 @@ class Client:
             'referer': 'https://pluto.tv/',
             }
 
-        epg_params = {
-            'start': start_time,
-            'channelIds': '',
-            'duration': '720',
-            }
-
         if country_code in self.x_forward.keys():
             epg_headers.update(self.x_forward.get(country_code))
 
         station_list, error = self.channels(country_code)
         if error: return None, error
 
-        id_values = [d['id'] for d in station_list]
-        group_size = 100
-        grouped_id_values = [id_values[i:i + group_size] for i in range(0, len(id_values), group_size)]
-        # country_data = self.epg_data.get(country_code, [])
-        country_data = []
-
-        for i in range(range_count):
-            if end_time != start_time:
-                start_time = end_time
-                epg_params.update({'start': start_time})
-            print(f'Retrieving {country_code} EPG data for {start_time}')
-
-            for group in grouped_id_values:
-                epg_params.update({"channelIds": ','.join(map(str, group))})
-                try:
-                    response = self.session.get(url, params=epg_params, headers=epg_headers)
-                except Exception as e:
-                    return None, (f"Error Exception type: {type(e).__name__}")
-                
-                if response.status_code != 200:
-                    return None, f"HTTP failure {response.status_code}: {response.text}"
-                country_data.append(response.json())
-
-
-            end_time = datetime.strptime(response.json()["meta"]["endDateTime"], "%Y-%m-%dT%H:%M:%S.%fZ").replace(tzinfo=pytz.utc).strftime("%Y-%m-%dT%H:00:00.000Z")
-
+        # Channels whose data has completely expired start over
+        for channel_id in [channel_id for channel_id, guide in self.epg_store.items() if guide['horizon'] <= now]:
+            del self.epg_store[channel_id]
+            self.guide_starts.pop(channel_id, None)
+
+        # Channels already checked during this refresh through another country are not requested again,
+        # and channels another country is fetching right now are waited for instead of requested twice.
+        # The others are claimed and grouped by the horizon they have already been retrieved up to.
+        station_ids = list(dict.fromkeys(d['id'] for d in station_list))
+        pending = {}
+        claimed = Event()
+        waiting = []
+        with self.epg_claims_lock:
+            for channel_id in station_ids:
+                if channel_id in self.epg_claims:
+                    waiting.append(self.epg_claims[channel_id])
+                    continue
+                guide = self.epg_store.get(channel_id)
+                if guide is None:
+                    pending.setdefault(None, []).append(channel_id)
+                elif guide['checked'] != start_time:
+                    pending.setdefault(guide['horizon'], []).append(channel_id)
+                else:
+                    continue
+                self.epg_claims[channel_id] = claimed
+        try:
+            error = self.fetch_pending(country_code, pending, url, epg_headers, station_ids, start_datetime, horizon_datetime, revalidate_end, now)
+        finally:
+            with self.epg_claims_lock:
+                for channel_ids in pending.values():
+                    for channel_id in channel_ids:
+                        del self.epg_claims[channel_id]
+            claimed.set()
+        if error: return None, error
 
-        self.epg_data.update({country_code: country_data})
+        # Waiting on channels another country is fetching is its own phase, not part of the transform
+        if waiting:
+            wait_start = time.perf_counter()
+            for other in set(waiting):
+                other.wait(EPG_CLAIM_TIMEOUT)
+            EPG_PHASE_SECONDS.observe(time.perf_counter() - wait_start, phase='claim_wait', target=country_code)
+
+        transform_start = time.perf_counter()
+        # Each country's guide references the shared timelines of its channels
+        country_data = [{'data': [{'channelId': channel_id, 'timelines': self.epg_store[channel_id]['timelines']}
+                                  for channel_id in station_ids if channel_id in self.epg_store]}]
+        EPG_PHASE_SECONDS.observe(time.perf_counter() - transform_start, phase='transform', target=country_code)
+        return country_data, None
+
+    def fetch_pending(self, country_code, pending, url, epg_headers, station_ids, start_datetime, horizon_datetime, revalidate_end, now):
+        start_time = start_datetime.strftime("%Y-%m-%dT%H:00:00.000Z")
+        horizon = horizon_datetime.strftime("%Y-%m-%dT%H:00:00.000Z")
+
+        # Time ranges to request for each group: everything up to the horizon for new channels,
+        # otherwise the re-validation window near now plus the hours beyond what is already stored
+        pending_ranges = {}
+        for stored_horizon, channel_ids in pending.items():
+            ranges = [(start_datetime, horizon_datetime)]
+            if stored_horizon is not None:
+                stored_end = max(datetime.strptime(stored_horizon, "%Y-%m-%dT%H:%M:%S.%fZ").replace(tzinfo=pytz.utc), revalidate_end)
+                ranges = [(start_datetime, revalidate_end)] + ([(stored_end, horizon_datetime)] if stored_end < horizon_datetime else [])
+            pending_ranges[stored_horizon] = ranges
+
+        # Batch size and window length come from this country's planner
+        batch_planner = self.planners.setdefault(country_code, planner.BatchPlanner(EPG_GROUP_BOUNDS, EPG_WINDOW_BOUNDS, self.epg_workers, HTTP_TIMEOUT[1] / 3))
+        pending_count = sum(len(channel_ids) for channel_ids in pending.values())
+        span = max((int((range_end - range_start).total_seconds() // 60) for ranges in pending_ranges.values() for range_start, range_end in ranges), default=0)
+        group_size, window_minutes, estimate = batch_planner.plan(pending_count, span)
+        window = timedelta(minutes=window_minutes)
+
+        requests_list = []
+        for stored_horizon, channel_ids in pending.items():
+            for range_start, range_end in pending_ranges[stored_horizon]:
+                window_start = range_start
+                while window_start < range_end:
+                    duration = min(window, range_end - window_start)
+                    for i in range(0, len(channel_ids), group_size):
+                        requests_list.append({'start': window_start.strftime("%Y-%m-%dT%H:00:00.000Z"),
+                                              'channelIds': ','.join(map(str, channel_ids[i:i + group_size])),
+                                              'duration': str(int(duration.total_seconds() // 60))})
+                    window_start += duration
+
+        def fetch_group(params):
+            request_start = time.perf_counter()
+            try:
+                response = self.upstream_get('timelines', country_code, url, params=params, headers=epg_headers)
+            except Exception as e:
+                return None, (f"Error Exception type: {type(e).__name__}")
+
+            if response.status_code != 200:
+                return None, f"HTTP failure {response.status_code}: {response.text}"
+            batch_planner.observe(params['channelIds'].count(',') + 1, int(params['duration']),
+                                  time.perf_counter() - request_start, len(response.content))
+            return response.json(), None
+
+        plan = f"{group_size} channels x {window_minutes} minutes" + (f", estimated {estimate:.2f}s" if estimate is not None else "")
+        print(f'Retrieving {country_code} EPG data for {pending_count} of {len(station_ids)} channels through {horizon} ({len(requests_list)} requests of up to {plan})')
+        fetch_start = time.monotonic()
+
+        # A failed request only costs the channels in it; they keep what is stored and are retried next refresh
+        fetched = {}
+        failed = set()
+        errors = []
+        skipped = 0
+        transform_seconds = 0.0
+        with ThreadPoolExecutor(max_workers=self.epg_workers) as pool:
+            for params, (data, error) in zip(requests_list, pool.map(fetch_group, requests_list)):
+                if error:
+                    errors.append(error)
+                    failed.update(params['channelIds'].split(','))
+                    continue
+                transform_start = time.perf_counter()
+                range_start = params['start']
+                range_end = (datetime.strptime(range_start, "%Y-%m-%dT%H:%M:%S.%fZ") + timedelta(minutes=int(params['duration']))).strftime("%Y-%m-%dT%H:00:00.000Z")
+                for entry in data.get("data", []):
+                    ranges, timelines = fetched.setdefault(entry["channelId"], ([], []))
+                    ranges.append((range_start, range_end))
+                    for timeline in entry["timelines"]:
+                        try:
+                            timelines.append(Programme.from_timeline(timeline))
+                        except (KeyError, TypeError, AttributeError):
+                            skipped += 1
+                transform_seconds += time.perf_counter() - transform_start
+        if requests_list:
+            elapsed = time.monotonic() - fetch_start
+            channel_hours = sum((params['channelIds'].count(',') + 1) * int(params['duration']) for params in requests_list) / 60
+            print(f'Retrieved {country_code} EPG data in {elapsed:.2f}s ({channel_hours / max(elapsed, 1e-9):.0f} channel-hours/s)')
+        # Timelines are converted as responses arrive; whatever else the loop waited on was the fetch
+        EPG_PHASE_SECONDS.observe(time.monotonic() - fetch_start - transform_seconds, phase='fetch', target=country_code)
+        transform_start = time.perf_counter()
+        if skipped:
+            print(f'[WARNING] Skipped {skipped} incomplete {country_code} EPG entries')
+        if errors:
+            # With nothing retrieved at all, the previous files are better than a guide built from what is left
+            if len(errors) == len(requests_list): return errors[0]
+            print(f'[WARNING] {len(errors)} of {len(requests_list)} {country_code} EPG requests failed, keeping stored data for {len(failed)} channels: {errors[0]}')
+
+        # Merge into the store: fetched ranges replace what was stored for them, ended programmes are dropped
+        for channel_ids in pending.values():
+            for channel_id in channel_ids:
+                guide = self.epg_store.get(channel_id, {'timelines': []})
+                ranges, timelines = fetched.get(channel_id, ([], []))
+                by_start = {timeline.start: timeline for timeline in guide['timelines']
+                            if not any(range_start <= timeline.start < range_end for range_start, range_end in ranges)}
+                for timeline in timelines:
+                    by_start[timeline.start] = timeline
+                # A channel with a failed request keeps its stored horizon (a new one starts from now) and stays unchecked
+                complete = channel_id not in failed
+                self.epg_store[channel_id] = {'timelines': sorted((timeline for timeline in by_start.values() if timeline.stop > now), key=lambda timeline: timeline.start),
+                                              'horizon': horizon if complete else guide.get('horizon', start_time),
+                                              'checked': start_time if complete else guide.get('checked')}
+        EPG_PHASE_SECONDS.observe(transform_seconds + time.perf_counter() - transform_start, phase='transform', target=country_code)
         return None
 
     def epg_json(self, country_code):
-        error_code = self.update_epg(country_code)
+        country_data, error_code = self.update_epg(country_code)
         if error_code:
             print("error")
             return None, error_code
-        return self.epg_data, None
-
-    def find_tuples_by_value(self, dictionary, target_value):
-        result_list = []  # Initialize an empty list
-        for key, values in dictionary.items():
-            if target_value in values:
-                result_list.extend(key)  # Add the first element of the tuple to the result list
-        return result_list if result_list else [target_value]  # Return None if the value is not found in any list
-
-    def read_epg_data(self, resp, root):
-        seriesGenres = {
-            ("Animated",): ["Family Animation", "Cartoons"],
-            ("Educational",): ["Education & Guidance", "Instructional & Educational"],
-            ("News",): ["News and Information", "General News", "News + Opinion", "General News"],
-            ("History",): ["History & Social Studies"],
-            ("Politics",): ["Politics"],
-            ("Action",):
-                [
-                  "Action & Adventure",
-                  "Action Classics",
-                  "Martial Arts",
-                  "Crime Action",
-                  "Family Adventures",
-                  "Action Sci-Fi & Fantasy",
-                  "Action Thrillers",
-                  "African-American Action",
-                ],
-            ("Adventure",): ["Action & Adventure", "Adventures", "Sci-Fi Adventure"],
-            ("Reality",):
-                [
-                  "Reality",
-                  "Reality Drama",
-                  "Courtroom Reality",
-                  "Occupational Reality",
-                  "Celebrity Reality",
-                ],
-            ("Documentary",):
-                [
-                  "Documentaries",
-                  "Social & Cultural Documentaries",
-                  "Science and Nature Documentaries",
-                  "Miscellaneous Documentaries",
-                  "Crime Documentaries",
-                  "Travel & Adventure Documentaries",
-                  "Sports Documentaries",
-                  "Military Documentaries",
-                  "Political Documentaries",
-                  "Foreign Documentaries",
-                  "Religion & Mythology Documentaries",
-                  "Historical Documentaries",
-                  "Biographical Documentaries",
-                  "Faith & Spirituality Documentaries",
-                ],
-            ("Biography",): ["Biographical Documentaries", "Inspirational Biographies"],
-            ("Science Fiction",): ["Sci-Fi Thrillers", "Sci-Fi Adventure", "Action Sci-Fi & Fantasy"],
-            ("Thriller",): ["Sci-Fi Thrillers", "Thrillers", "Crime Thrillers"],
-            ("Biography",): ["Biographical Documentaries", "Inspirational Biographies"],
-            ("Talk",): ["Talk & Variety", "Talk Show"],
-            ("Variety",): ["Sketch Comedies"],
-            ("Home Improvement",): ["Art & Design", "DIY & How To", "Home Improvement"],
-            ("House/garden",): ["Home & Garden"],
-            # ("Science",): ["Science and Nature Documentaries"],
-            # ("Nature",): ["Science and Nature Documentaries", "Animals"],
-            ("Cooking",): ["Cooking Instruction", "Food & Wine", "Food Stories"],
-            ("Travel",): ["Travel & Adventure Documentaries", "Travel"],
-            ("Western",): ["Westerns", "Classic Westerns"],
-            ("LGBTQ",): ["Gay & Lesbian", "Gay & Lesbian Dramas", "Gay"],
-            ("Game show",): ["Game Show"],
-            ("Military",): ["Classic War Stories"],
-            ("Comedy",):
-                [
-                  "Cult Comedies",
-                  "Spoofs and Satire",
-                  "Slapstick",
-                  "Classic Comedies",
-                  "Stand-Up",
-                  "Sports Comedies",
-                  "African-American Comedies",
-                  "Showbiz Comedies",
-                  "Sketch Comedies",
-                  "Teen Comedies",
-                  "Latino Comedies",
-                  "Family Comedies",
-                ],
-            ("Crime",): ["Crime Action", "Crime Drama", "Crime Documentaries"],
-            ("Sports",): ["Sports","Sports & Sports Highlights","Sports Documentaries", "Poker & Gambling"],
-            ("Poker & Gambling",): ["Poker & Gambling"],
-            ("Crime drama",): ["Crime Drama"],
-            ("Drama",):
-                [
-                  "Classic Dramas",
-                  "Family Drama",
-                  "Indie Drama",
-                  "Romantic Drama",
-                  "Crime Drama",
-                ],
-            ("Children",): ["Kids", "Children & Family", "Kids' TV", "Cartoons", "Animals", "Family Animation", "Ages 2-4", "Ages 11-12",],
-            ("Animated",): ["Family Animation", "Cartoons"]
-            }
+        # Stored programmes are compact records; expand them into the upstream timeline layout
+        return {country_code: [{'data': [{'channelId': entry['channelId'], 'timelines': [timeline.as_dict() for timeline in entry['timelines']]}
+                                         for entry in epg_list['data']]}
+                               for epg_list in country_data]}, None
+
+    def guide_index(self, channel_id):
+        # A channel's stored programmes with their start times for bisecting, rebuilt when a refresh replaces them
+        guide = self.epg_store.get(channel_id)
+        if guide is None:
+            return [], []
+        timelines = guide['timelines']
+        indexed = self.guide_starts.get(channel_id)
+        if indexed is None or indexed[0] is not timelines:
+            indexed = (timelines, [timeline.start for timeline in timelines])
+            self.guide_starts[channel_id] = indexed
+        return indexed
+
+    def guide_channel_ids(self, country_code):
+        # Channels of the cached lists; guide queries never contact Pluto
+        self.load_snapshot()
+        codes = list(self.all_channels) if country_code == 'all' else [country_code]
+        return list(dict.fromkeys(station['id'] for code in codes for station in self.all_channels.get(code, [])))
+
+    def has_guide_channel(self, country_code, channel_id):
+        # Set lookups against each cached channel list, rebuilt when a refresh replaces the list
+        self.load_snapshot()
+        codes = list(self.all_channels) if country_code == 'all' else [country_code]
+        for code in codes:
+            stations = self.all_channels.get(code)
+            if stations is None:
+                continue
+            indexed = self.guide_channels.get(code)
+            if indexed is None or indexed[0] is not stations:
+                indexed = (stations, {station['id'] for station in stations})
+                self.guide_channels[code] = indexed
+            if channel_id in indexed[1]:
+                return True
+        return False
+
+    def guide_range(self, channel_id, start=None, end=None):
+        # Programmes airing at any time in [start, end); an empty start means now and an empty end the end of the guide
+        start = guide_time(start or None)
+        end = guide_time(end) if end else None
+        timelines, starts = self.guide_index(channel_id)
+        first = bisect_right(starts, start) - 1
+        if first < 0 or timelines[first].stop <= start:
+            first += 1
+        last = len(starts) if end is None else bisect_left(starts, end)
+        return [timeline.as_dict() for timeline in timelines[first:last]]
+
+    def now_next(self, country_code, at=None):
+        at = at or guide_time()
+        guide = {}
+        for channel_id in self.guide_channel_ids(country_code):
+            timelines, starts = self.guide_index(channel_id)
+            i = bisect_right(starts, at)
+            current = timelines[i - 1] if i and timelines[i - 1].stop > at else None
+            upcoming = timelines[i] if i < len(timelines) else None
+            guide[channel_id] = {'now': current.as_dict() if current else None,
+                                 'next': upcoming.as_dict() if upcoming else None}
+        return guide
+
+    def read_epg_data(self, resp):
 
         for entry in resp["data"]:
+            channel_id = entry["channelId"]
             for timeline in entry["timelines"]:
-                # Create programme element
-                programme = ET.SubElement(root, "programme", attrib={"channel": entry["channelId"],
-                                                                 "start": datetime.strptime(timeline["start"], "%Y-%m-%dT%H:%M:%S.%fZ").replace(tzinfo=pytz.utc).strftime("%Y%m%d%H%M%S %z"),
-                                                                 "stop": datetime.strptime(timeline["stop"], "%Y-%m-%dT%H:%M:%S.%fZ").replace(tzinfo=pytz.utc).strftime("%Y%m%d%H%M%S %z")})
-                # Add sub-elements to programme
-                title = ET.SubElement(programme, "title")
-                title.text = self.strip_illegal_characters(timeline["title"])
-                if timeline["episode"].get("series", {}).get("type", "") == "live":
-                    if timeline["episode"]["clip"]["originalReleaseDate"] == timeline["start"]:
-                        live = ET.SubElement(programme, "live")
-                    if timeline["episode"].get("season", None):
-                        episode_num_onscreen = ET.SubElement(programme, "episode-num", attrib={"system": "onscreen"})
-                        episode_num_onscreen.text = f'S{timeline["episode"]["season"]:02d}E{timeline["episode"]["number"]:02d}'
-                        episode_num_pluto = ET.SubElement(programme, "episode-num", attrib={"system": "pluto"})
-                        episode_num_pluto.text = timeline["episode"]["_id"]
-                elif timeline["episode"].get("series", {}).get("type", "") == "tv":
-                    episode_num_onscreen = ET.SubElement(programme, "episode-num", attrib={"system": "onscreen"})
-                    episode_num_onscreen.text = f'S{timeline["episode"]["season"]:02d}E{timeline["episode"]["number"]:02d}'
-                    episode_num_pluto = ET.SubElement(programme, "episode-num", attrib={"system": "pluto"})
-                    episode_num_pluto.text = timeline["episode"]["_id"]
-                episode_num_air_date = ET.SubElement(programme, "episode-num", attrib={"system": "original-air-date"})
-                episode_num_air_date.text = datetime.strptime(timeline["episode"]["clip"]["originalReleaseDate"], "%Y-%m-%dT%H:%M:%S.%fZ").replace(tzinfo=pytz.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + 'Z'
-                desc = ET.SubElement(programme, "desc")
-                desc.text = self.strip_illegal_characters(timeline["episode"]["description"]).replace('&quot;', '"')
-                icon_programme = ET.SubElement(programme, "icon", attrib={"src": timeline["episode"]["series"]["tile"]["path"]})
-                date = ET.SubElement(programme, "date")
-                date.text = datetime.strptime(timeline["episode"]["clip"]["originalReleaseDate"], "%Y-%m-%dT%H:%M:%S.%fZ").strftime("%Y%m%d")
-                # if timeline["episode"].get("series", {}).get("type", "") == "tv":
-                series_id_pluto = ET.SubElement(programme, "series-id", attrib={"system": "pluto"})
-                series_id_pluto.text = timeline["episode"]["series"]["_id"]
-                if timeline["title"].lower() != timeline["episode"]["name"].lower():
-                    sub_title = ET.SubElement(programme, "sub-title")
-                    sub_title.text = self.strip_illegal_characters(timeline["episode"]["name"])
-                categories = []
-                if timeline["episode"].get("genre", None) is not None:
-                    genre = timeline["episode"]["genre"]
-                    result = self.find_tuples_by_value(seriesGenres, genre)
-                    categories.extend(result)
-                if timeline["episode"].get("series", {}).get("type", "") == "tv":
-                    categories.append("Series")
-                if timeline["episode"].get("series", {}).get("type", "") == "film":
-                    categories.append("Movie")
-                if timeline["episode"].get("subGenre", None) is not None:
-                    subGenre = timeline["episode"]["subGenre"]
-                    result = self.find_tuples_by_value(seriesGenres, subGenre)
-                    categories.extend(result)
-                # categories = sorted(categories)
-
-                unique_list = []
-                for item in categories:
-                    if item not in unique_list:
-                        unique_list.append(item)
-
-                for category in unique_list:
-                    category_elem = ET.SubElement(programme, "category")
-                    category_elem.text = category
-        return root
+                # Identical programmes are rendered once and reused across runs and countries
+                key = (channel_id, timeline.start, timeline.stop, timeline.episode_id)
+                programme = self.programme_cache.get(key)
+                if programme is None:
+                    programme = self.programme_record(channel_id, timeline)
+                    self.programme_cache.put(key, programme, timeline.stop)
+                yield programme
+
+    def programme_record(self, channel_id, timeline):
+        series_type = timeline.series_type
+        original_air_date, date = air_date(timeline.release_date)
+
+        # Programme attributes
+        attrib = {"channel": channel_id,
+                  "start": xmltv_time(timeline.start),
+                  "stop": xmltv_time(timeline.stop)}
+        # Add sub-elements to programme
+        elements = [xmltv.sub_element("title", text=self.strip_illegal_characters(timeline.title))]
+        if series_type == "live":
+            if timeline.release_date == timeline.start:
+                elements.append(xmltv.sub_element("live"))
+            if timeline.season:
+                elements.append(xmltv.sub_element("episode-num", {"system": "onscreen"}, f'S{timeline.season:02d}E{timeline.number:02d}'))
+                elements.append(xmltv.sub_element("episode-num", {"system": "pluto"}, timeline.episode_id))
+        elif series_type == "tv":
+            elements.append(xmltv.sub_element("episode-num", {"system": "onscreen"}, f'S{timeline.season:02d}E{timeline.number:02d}'))
+            elements.append(xmltv.sub_element("episode-num", {"system": "pluto"}, timeline.episode_id))
+        elements.append(xmltv.sub_element("episode-num", {"system": "original-air-date"}, original_air_date))
+        elements.append(xmltv.sub_element("desc", text=self.strip_illegal_characters(timeline.description).replace('&quot;', '"')))
+        elements.append(xmltv.sub_element("icon", {"src": timeline.tile}))
+        elements.append(xmltv.sub_element("date", text=date))
+        elements.append(xmltv.sub_element("series-id", {"system": "pluto"}, timeline.series_id))
+        if timeline.title.lower() != timeline.name.lower():
+            elements.append(xmltv.sub_element("sub-title", text=self.strip_illegal_characters(timeline.name)))
+
+        # dict keys keep the first occurrence of each category in order
+        categories = {}
+        if timeline.genre is not None:
+            categories.update(dict.fromkeys(genre_categories(timeline.genre)))
+        if series_type == "tv":
+            categories["Series"] = None
+        if series_type == "film":
+            categories["Movie"] = None
+        if timeline.sub_genre is not None:
+            categories.update(dict.fromkeys(genre_categories(timeline.sub_genre)))
+
+        for category in categories:
+            elements.append(xmltv.sub_element("category", text=category))
+
+        # Create programme record
+        return xmltv.record("programme", attrib, elements)
 
     def get_all_epg_data(self, country_code):
-        all_epg_data = []
-        # print (country_code)
-        channelIds_seen = {}
         range_count = 3
 
+        # Channels checked during this hour through the per-country builds are not requested again
+        guides = {}
         for country in country_code:
-            error_code = self.update_epg(country, range_count)
-            if error_code: return error_code
-
-            for epg_list in self.epg_data.get(country):
-                data_list = epg_list.get('data')
-                # Make a copy of the list for iteration to avoid modifying the list while iterating
-                for entry in data_list[:]:
-                    channelId = entry.get('channelId')
-                    if channelId in channelIds_seen:
-                        if channelIds_seen.get(channelId, 0) < range_count:
-                            channelIds_seen.update({channelId: (channelIds_seen.get(channelId, 0) + 1)})
-                            # print(f"[INFO] Adding {country}: {channelId}")
-                        else:
-                            # print(f"[INFO] Beyond {range_count}: Skipping duplicate entry for {country}: {channelId}")
-                            data_list.remove(entry)
-                    else:
-                        channelIds_seen.update({channelId: 1})
-                epg_data_dict = {'data': data_list}
-                all_epg_data.append(epg_data_dict)
-
-            
-        # print(f"[INFO] Length {len(all_epg_data)}")
-        return(all_epg_data)
-
-
-    def create_xml_file(self, country_code):
+            guides[country], error_code = self.update_epg(country, range_count)
+            if error_code: return None, error_code
+
+        return self.merge_epg_data(country_code, guides), None
+
+    def merge_epg_data(self, country_code, guides):
+        # Each channel has a single entry holding all of its timelines, so only the first country's is kept.
+        # Entries are picked in one pass over the channel ids and handed to the writer as they are produced,
+        # leaving the per-country guides untouched.
+        channelIds_seen = set()
+        for country in country_code:
+            for epg_list in guides.get(country, []):
+                yield {'data': [entry for entry in epg_list.get('data')
+                                if entry['channelId'] not in channelIds_seen and not channelIds_seen.add(entry['channelId'])]}
+
+
+    def write_xml_file(self, xml_file_path, station_list, program_data):
+        # Cached programmes that have already ended are no longer needed
+        self.programme_cache.evict(datetime.now(pytz.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ"))
+
+        # Stream Channel and Programme records straight to the XML file and its gzip copy
+        start = time.perf_counter()
+        with xmltv.XMLTVWriter(xml_file_path, {"generator-info-name": "jgomez177", "generated-ts": ""},
+                               compress_level=GZIP_LEVEL, compress_threads=gzip_threads()) as writer:
+            # Create Channel Elements from list of Stations
+            for station in station_list:
+                writer.write(xmltv.channel_record(station["id"], self.strip_illegal_characters(station["name"]), station["logo"]))
+
+            for elem in program_data:
+                for programme in self.read_epg_data(elem):
+                    writer.write(programme)
+
+        # Timings and sizes travel back with the cache counters, as the build may run in the worker process
+        stats = self.programme_cache.stats()
+        stats.update(writer.compressor.stats())
+        stats.update({"serialize_seconds": time.perf_counter() - start - stats["compress_seconds"],
+                      "bytes": writer.bytes_written,
+                      "compressed_bytes": writer.compressed_bytes})
+        return stats
+
+    def programme_cache_stats(self):
+        # Programme cache counters accumulated since the previous call
+        stats = dict(self.cache_stats)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        self.cache_stats.update({"hits": 0, "misses": 0})
+        return stats
+
+    def create_xml_file(self, country_code, refresh=True):
         if isinstance(country_code, str):
-            error_code = self.update_epg(country_code)
-            if error_code: return error_code
+            # A scheduled build starts from a fresh channel list unless the caller has just refreshed it
+            station_list, error = self.channels(country_code, refresh=refresh)
+            if error: return None, error
 
-            station_list, error = self.channels(country_code)
+            program_data, error = self.update_epg(country_code)
             if error: return None, error
 
             xml_file_path = f"epg-{country_code}.xml"
@@ -502,51 +1183,39 @@ class Client:
             print("The variable is neither a string nor a list.")
             return None
 
-        compressed_file_path = f"{xml_file_path}.gz"
-        root = ET.Element("tv", attrib={"generator-info-name": "jgomez177", "generated-ts": ""})
-
-        # Create Channel Elements from list of Stations
-        for station in station_list:
-            channel = ET.SubElement(root, "channel", attrib={"id": station["id"]})
-            display_name = ET.SubElement(channel, "display-name")
-            display_name.text = self.strip_illegal_characters(station["name"])
-            icon = ET.SubElement(channel, "icon", attrib={"src": station["logo"]})
-
         # Create Programme Elements
-        if isinstance(country_code, str):
-            program_data =  self.epg_data.get(country_code, [])
-        else:
+        if isinstance(country_code, list):
             # Write program_data for all countries
-            program_data = self.get_all_epg_data(country_code)
-            #print(len(program_data))
-            #for elem in program_data:
-            #    print(len(elem.get("data")))
-            #program_data = []
+            program_data, error = self.get_all_epg_data(country_code)
+            if error: return None, error
         # print(f"Program data: {len(program_data)}")
-        for elem in program_data:
-            root = self.read_epg_data(elem, root)
-
-
-        # Create an ElementTree object
-        tree = ET.ElementTree(root)
-        ET.indent(tree, '  ')
-
-        # Create a DOCTYPE declaration
-        doctype = '<!DOCTYPE tv SYSTEM "xmltv.dtd">'
 
-        # Concatenate the XML and DOCTYPE declarations in the desired order
-        xml_declaration = '<?xml version=\'1.0\' encoding=\'utf-8\'?>'
-        output_content = xml_declaration + '\n' + doctype + '\n' + ET.tostring(root, encoding='utf-8').decode('utf-8')
-
-        # Write the concatenated content to the output file
-        with open(xml_file_path, "w", encoding='utf-8') as f:
-            f.write(output_content)
-
-        # Compress the XML file
-        with open(xml_file_path, 'rb') as file:
-            with gzip.open(compressed_file_path, 'wb') as compressed_file:
-                compressed_file.writelines(file)
-
-        # Clear the EPG data after writing full XML File
-        self.epg_data = {}
+        # Rendering and compression run in the EPG worker process so the server keeps answering requests
+        if self.epg_worker is not None:
+            # The whole guide is pickled into one message, and kept for the in-process fallback
+            program_data = list(program_data)
+            try:
+                stats = self.epg_worker.write_xml_file(xml_file_path, station_list, program_data)
+            except Exception as e:
+                print(f"[ERROR] EPG worker failed, writing {xml_file_path} in process: {e}")
+                stats = self.write_xml_file(xml_file_path, station_list, program_data)
+        else:
+            stats = self.write_xml_file(xml_file_path, station_list, program_data)
+        for key in ("hits", "misses"):
+            self.cache_stats[key] += stats[key]
+        self.cache_stats["entries"] = stats["entries"]
+
+        target = country_code if isinstance(country_code, str) else 'all'
+        EPG_PHASE_SECONDS.observe(stats["serialize_seconds"], phase='serialize', target=target)
+        EPG_PHASE_SECONDS.observe(stats["compress_seconds"], phase='compress', target=target)
+        PROGRAMME_CACHE_LOOKUPS.inc(stats["hits"], result='hit')
+        PROGRAMME_CACHE_LOOKUPS.inc(stats["misses"], result='miss')
+        PROGRAMME_CACHE_ENTRIES.set(stats["entries"])
+        EPG_ARTIFACT_BYTES.set(stats["bytes"], file=xml_file_path)
+        EPG_ARTIFACT_BYTES.set(stats["compressed_bytes"], file=f"{xml_file_path}.gz")
+        EPG_COMPRESSION_RATIO.set(stats["compression_ratio"], file=f"{xml_file_path}.gz")
+        EPG_COMPRESS_THROUGHPUT.set(stats["compress_throughput"], file=f"{xml_file_path}.gz")
+        print(f"[INFO] Compressed {xml_file_path}: {stats['bytes'] / 1e6:.1f} MB to {stats['compressed_bytes'] / 1e6:.1f} MB "
+              f"({stats['compression_ratio']:.1f}x) at {stats['compress_throughput'] / 1e6:.1f} MB per CPU second, "
+              f"{stats['compress_threads']} threads, {stats['compress_seconds']:.2f}s")
         return None
@@ -1,8 +1,9 @@
 from gevent.pywsgi import WSGIServer
-from flask import Flask, redirect, request, Response, send_file
-from threading import Thread
-import os, sys, importlib, schedule, time, re, uuid, unicodedata
+from flask import Flask, redirect, request, Response, g
+import os, sys, importlib, time, re, uuid, unicodedata, hashlib, mimetypes, metrics, scheduler
 from urllib.parse import urlparse, urlencode, urlunparse, parse_qs
+from werkzeug.exceptions import HTTPException
+from werkzeug.wsgi import wrap_file
 from datetime import datetime, timedelta
 
 # import flask module
@@ -20,6 +21,16 @@ try:
 except:
     port = 7777
 
+# Minutes between refreshes of each country's EPG, and how many refreshes may run at once
+try:
+    refresh_interval = timedelta(minutes=max(1, int(os.environ.get("PLUTO_REFRESH_MINUTES", 120))))
+except:
+    refresh_interval = timedelta(minutes=120)
+try:
+    refresh_concurrency = max(1, int(os.environ.get("PLUTO_REFRESH_CONCURRENCY", 1)))
+except:
+    refresh_concurrency = 1
+
 pluto_country_list = os.environ.get("PLUTO_CODE")
 if pluto_country_list:
    pluto_country_list = pluto_country_list.split(',')
@@ -34,6 +45,23 @@ providers = {
     provider: importlib.import_module(provider).Client(),
 }
 
+# Rendered playlists keyed by (provider, country_code, channel_id_format, host)
+PLAYLIST_CACHE_SIZE = 64
+playlist_cache = {}
+
+ROUTE_SECONDS = metrics.histogram("pluto_http_request_seconds", "Time to produce a response, per route", ("route", "status"))
+PLAYLIST_CACHE_LOOKUPS = metrics.counter("pluto_playlist_cache_lookups_total", "Rendered playlist cache lookups", ("result",))
+
+@app.before_request
+def start_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_request(response):
+    if 'request_start' in g:
+        ROUTE_SECONDS.observe(time.perf_counter() - g.request_start, route=request.endpoint or 'unmatched', status=response.status_code)
+    return response
+
 def remove_non_printable(s):
     return ''.join([char for char in s if not unicodedata.category(char).startswith('C')])
 
@@ -95,6 +123,10 @@ def index():
         ul += f"<li>INVALID COUNTRY CODE in \"{', '.join(pluto_country_list).upper()}\"</li>\n"
     return f"{url}<ul>{ul}</ul></div></section></body></html>"
 
+@app.get("/metrics")
+def metrics_endpoint():
+    return Response(metrics.REGISTRY.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
 @app.route("/<country_code>/token")
 def token(country_code):
     resp, error = providers[provider].resp_data(country_code)
@@ -102,6 +134,10 @@ def token(country_code):
     token = resp.get('sessionToken', None)
     return(token)
 
+@app.route("/<country_code>/token_status")
+def token_status(country_code):
+    return(providers[provider].token_status(country_code))
+
 @app.route("/<country_code>/resp")
 def resp(country_code):
     resp, error = providers[provider].resp_data(country_code)
@@ -122,16 +158,58 @@ def epg_json(provider, country_code):
         if err: return err
         return epg.get(country_code)
 
+@app.get("/<provider>/<country_code>/now_next.json")
+def now_next(provider, country_code):
+    if country_code not in ALLOWED_COUNTRY_CODES:
+        return "Invalid county code", 400
+    return providers[provider].now_next(country_code)
+
+@app.get("/<provider>/<country_code>/guide/<channel_id>")
+def guide(provider, country_code, channel_id):
+    if country_code not in ALLOWED_COUNTRY_CODES:
+        return "Invalid county code", 400
+    if not providers[provider].has_guide_channel(country_code, channel_id):
+        return "Channel not found", 404
+    try:
+        timelines = providers[provider].guide_range(channel_id, request.args.get('start'), request.args.get('end'))
+    except ValueError:
+        return "Invalid start or end, expected an ISO 8601 time", 400
+    return {'channelId': channel_id, 'timelines': timelines}
+
 @app.get("/<provider>/<country_code>/stitcher.json")
 def stitch_json(provider, country_code):
     resp, error= providers[provider].resp_data(country_code)
     if error: return error, 500
     return resp
 
+def render_playlist(stations, provider, country_code, host, channel_id_format):
+    lines = ["#EXTM3U\r\n\r\n"]
+    for s in sorted(stations, key = lambda i: i.get('number', 0)):
+        if channel_id_format == 'id':
+            entry = [f"#EXTINF:-1 channel-id=\"{provider}-{s.get('id')}\""]
+        elif channel_id_format == 'slug_only':
+            entry = [f"#EXTINF:-1 channel-id=\"{s.get('slug')}\""]
+        else:
+            entry = [f"#EXTINF:-1 channel-id=\"{provider}-{s.get('slug')}\""]
+        entry.append(f" tvg-id=\"{s.get('id')}\"")
+        if s.get('number'): entry.append(f" tvg-chno=\"{s.get('number')}\"")
+        if s.get('group'): entry.append(f" group-title=\"{s.get('group')}\"")
+        if s.get('logo'): entry.append(f" tvg-logo=\"{s.get('logo')}\"")
+        if s.get('tmsid'): entry.append(f" tvg-name=\"{s.get('tmsid')}\"")
+        if s.get('name'): entry.append(f" tvc-guide-title=\"{s.get('name')}\"")
+        if s.get('summary'): entry.append(f" tvc-guide-description=\"{remove_non_printable(s.get('summary'))}\"")
+        if s.get('timeShift'): entry.append(f" tvg-shift=\"{s.get('timeShift')}\"")
+        entry.append(f",{s.get('name') or s.get('call_sign')}\n")
+        entry.append(f"http://{host}/{provider}/{country_code}/watch/{s.get('watchId') or s.get('id')}\n\n\n")
+        lines.append(''.join(entry))
+    return ''.join(lines)
+
 @app.get("/<provider>/<country_code>/playlist.m3u")
 def playlist(provider, country_code):
     if country_code.lower() == 'all':
-        stations, err = providers[provider].channels_all()
+        # Building the combined list renumbers every channel, so it waits until the cache turns out to be stale
+        providers[provider].load_snapshot()
+        stations, err = None, None
     elif country_code.lower() in ALLOWED_COUNTRY_CODES:
         stations, err = providers[provider].channels(country_code)
     else: # country_code not in ALLOWED_COUNTRY_CODES
@@ -139,34 +217,31 @@ def playlist(provider, country_code):
 
     host = request.host
     channel_id_format = request.args.get('channel_id_format','').lower()
-    
+    if channel_id_format not in ('id', 'slug_only'):
+        channel_id_format = ''
+
     if err is not None:
         return err, 500
-    stations = sorted(stations, key = lambda i: i.get('number', 0))
 
-    m3u = "#EXTM3U\r\n\r\n"
-    for s in stations:
-        url = f"http://{host}/{provider}/{country_code}/watch/{s.get('watchId') or s.get('id')}\n\n"
-
-        if channel_id_format == 'id':
-            m3u += f"#EXTINF:-1 channel-id=\"{provider}-{s.get('id')}\""
-        elif channel_id_format == 'slug_only':
-            m3u += f"#EXTINF:-1 channel-id=\"{s.get('slug')}\""
-        else:
-            m3u += f"#EXTINF:-1 channel-id=\"{provider}-{s.get('slug')}\""
-        m3u += f" tvg-id=\"{s.get('id')}\""
-        m3u += f" tvg-chno=\"{''.join(map(str, str(s.get('number', []))))}\"" if s.get('number') else ""
-        m3u += f" group-title=\"{''.join(map(str, s.get('group', [])))}\"" if s.get('group') else ""
-        m3u += f" tvg-logo=\"{''.join(map(str, s.get('logo', [])))}\"" if s.get('logo') else ""
-        m3u += f" tvg-name=\"{''.join(map(str, s.get('tmsid', [])))}\"" if s.get('tmsid') else ""
-        m3u += f" tvc-guide-title=\"{''.join(map(str, s.get('name', [])))}\"" if s.get('name') else ""
-        m3u += f" tvc-guide-description=\"{remove_non_printable(''.join(map(str, s.get('summary', []))))}\"" if s.get('summary') else ""
-        m3u += f" tvg-shift=\"{''.join(map(str, s.get('timeShift', [])))}\"" if s.get('timeShift') else ""
-        m3u += f",{s.get('name') or s.get('call_sign')}\n"
-        m3u += f"{url}\n"
-
-    response = Response(m3u, content_type='audio/x-mpegurl')
-    return (response)
+    # Rendered playlists are reused until the channel list behind them changes
+    key = (provider, country_code, channel_id_format, host)
+    version = providers[provider].channels_version('all' if country_code.lower() == 'all' else country_code)
+    cached = playlist_cache.get(key)
+    PLAYLIST_CACHE_LOOKUPS.inc(result='miss' if cached is None or cached[0] != version else 'hit')
+    if cached is None or cached[0] != version:
+        if stations is None:
+            stations, err = providers[provider].channels_all()
+            if err is not None:
+                return err, 500
+        m3u = render_playlist(stations, provider, country_code, host, channel_id_format)
+        cached = (version, m3u, hashlib.sha1(m3u.encode('utf-8')).hexdigest())
+        if len(playlist_cache) >= PLAYLIST_CACHE_SIZE:
+            playlist_cache.clear()
+        playlist_cache[key] = cached
+
+    response = Response(cached[1], content_type='audio/x-mpegurl')
+    response.set_etag(cached[2])
+    return (response.make_conditional(request))
 
 @app.get("/mjh_compatible/<provider>/<country_code>/playlist.m3u")
 def playlist_mjh_compatible(provider, country_code):
@@ -235,6 +310,28 @@ def watch(provider, country_code, id):
     print(video_url)
     return (redirect(video_url))
 
+def send_artifact(file_path, download_name, mimetype, as_attachment, content_encoding=None):
+    # EPG files are replaced by renaming a new build over them. The file is opened before it is
+    # inspected, so the validators and length always describe the build that is actually sent.
+    file = open(os.path.join(app.root_path, file_path), 'rb')
+    try:
+        stat = os.fstat(file.fileno())
+
+        response = Response(wrap_file(request.environ, file), mimetype=mimetype, direct_passthrough=True)
+        response.content_length = stat.st_size
+        response.last_modified = stat.st_mtime
+        # Each build is a new file, so its inode, modification time and size identify it
+        response.set_etag(f"{stat.st_ino:x}-{stat.st_mtime_ns:x}-{stat.st_size:x}{'-' + content_encoding if content_encoding else ''}")
+        response.cache_control.no_cache = True
+        response.headers.set('Content-Disposition', 'attachment' if as_attachment else 'inline', filename=download_name)
+        if content_encoding:
+            response.content_encoding = content_encoding
+        # An unsatisfiable Range raises RequestedRangeNotSatisfiable, answered as 416 with the file's length
+        return response.make_conditional(request, accept_ranges=True, complete_length=stat.st_size)
+    except Exception:
+        file.close()
+        raise
+
 @app.get("/<provider>/epg/<country_code>/<filename>")
 def epg_xml(provider, country_code, filename):
 
@@ -259,13 +356,22 @@ def epg_xml(provider, country_code, filename):
 
         # Return the file without explicitly opening it
         if filename in ALLOWED_EPG_FILENAMES: 
-            return send_file(file_path, as_attachment=False, download_name=file_path, mimetype='text/plain')
+            # Clients that accept gzip get the precompressed copy written alongside the XML
+            if request.accept_encodings['gzip'] and os.path.exists(os.path.join(app.root_path, f'{file_path}.gz')):
+                response = send_artifact(f'{file_path}.gz', file_path, 'text/plain', False, 'gzip')
+            else:
+                response = send_artifact(file_path, file_path, 'text/plain', False)
+            response.vary.add('Accept-Encoding')
+            return response
         elif filename in ALLOWED_GZ_FILENAMES:
-            return send_file(file_path, as_attachment=True, download_name=file_path)
+            return send_artifact(file_path, file_path, mimetypes.guess_type(file_path)[0], True)
 
     except FileNotFoundError:
         # Handle the case where the file is not found
         return "XML file not found", 404
+    except HTTPException:
+        # 416 and other HTTP errors carry their own status and headers
+        raise
     except Exception as e:
         # Handle other unexpected errors
         return f"An error occurred: {str(e)}", 500
@@ -275,53 +381,45 @@ def epg_xml(provider, country_code, filename):
         # Handle other unexpected errors
         return f"An error occurred: {str(e)}", 500
 
-# Define the function you want to execute every four hours
-def epg_scheduler():
-    print("[INFO] Running EPG Scheduler")
-    if all(item in ALLOWED_COUNTRY_CODES for item in pluto_country_list):
-        for code in pluto_country_list:
-            error = providers[provider].create_xml_file(code)
-            if error: print(f"{error}")
-        error = providers[provider].create_xml_file(pluto_country_list)
-        if error: print(f"{error}")
-    print("[INFO] EPG Scheduler Complete")
-
-# Schedule the function to run every two hours
-schedule.every(2).hours.do(epg_scheduler)
-
-# Define a function to run the scheduler in a separate thread
-def scheduler_thread():
-    # Run the task immediately when the thread starts
-    try:
-        epg_scheduler()
-    except Exception as e:
-        print(f"Error running initial task: {e}")
-
-    # Continue as Scheduled
-    while True:
-        try:
-            schedule.run_pending()
-            time.sleep(1)
-        except Exception as e:
-             print(f"[ERROR] Error in scheduler thread: {e}")
-
-# Function to monitor and restart the thread if needed
-def monitor_thread(thread_func):
-    thread = Thread(target=thread_func, daemon=True)
-    print("[INFO] Initializing Scheduler")
-    thread.start()
-
-    while True:
-        if not thread.is_alive():
-            print("[ERROR] Scheduler Thread Stopped. Restarting...")
-            thread.start()
-        time.sleep(15 * 60)  # Check every 15 minutes
-        print("[INFO] Checking Scheduler Thread")
+def refresh_country(code, refresh=True):
+    return providers[provider].create_xml_file(code, refresh)
+
+def refresh_all():
+    error = providers[provider].create_xml_file(pluto_country_list)
+    stats = providers[provider].programme_cache_stats()
+    print(f"[INFO] Programme cache: {stats['hits']} hits, {stats['misses']} misses ({stats['hit_rate']:.1%} hit rate), {stats['entries']} entries")
+    # Lets a restarted server answer from the state of this pass while it refreshes
+    providers[provider].save_snapshot()
+    return error
+
+def refresh_guides():
+    # Fetch every country's channels and guide at once; their requests share the connection pools and
+    # channels they have in common are fetched once. Builds later in the same hour only fetch what changed.
+    errors = providers[provider].update_epg_many(pluto_country_list)
+    for code, error in errors.items():
+        print(f"[ERROR] EPG refresh for {code} failed: {error}")
+    if errors:
+        return "; ".join(f"{code}: {error}" for code, error in errors.items())
+
+# A fetch of every country, then one build per country plus the combined guide, staggered over the refresh interval
+refresh_scheduler = scheduler.RefreshScheduler(refresh_interval, refresh_concurrency)
+if all(item in ALLOWED_COUNTRY_CODES for item in pluto_country_list):
+    refresh_scheduler.add("epg-fetch", refresh_guides)
+    for code in pluto_country_list:
+        refresh_scheduler.add(f"epg-{code}", lambda code=code: refresh_country(code, refresh=False))
+    refresh_scheduler.add("epg-all", refresh_all)
+
+@app.get("/scheduler")
+def scheduler_status():
+    return refresh_scheduler.status()
 
 if __name__ == '__main__':
     try:
-        # Start a monitoring thread
-        Thread(target=monitor_thread, args=(scheduler_thread,), daemon=True).start()
+        # Keep session tokens renewed ahead of expiry
+        providers[provider].start_token_refresh(pluto_country_list)
+
+        # Start the refresh jobs and the supervisor that keeps their workers running
+        refresh_scheduler.start()
 
         print(f"⇨ http server started on [::]:{port}")
         WSGIServer(('', port), app, log=None).serve_forever()
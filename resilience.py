@@ -0,0 +1,66 @@
+import time
+from collections import deque
+from threading import Lock
+
+# Building blocks for calling Pluto while it is slow or failing:
+# a circuit breaker per endpoint and a rolling latency window used to decide when to hedge.
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    # Closed: requests flow. After `failure_threshold` failures in a row the circuit opens and requests
+    # fail fast for `reset_timeout` seconds. Then a single trial request is let through (half open):
+    # success closes the circuit again, failure reopens it.
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.lock = Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = "half_open"
+                return True
+            return False
+
+    def success(self):
+        with self.lock:
+            self.state = "closed"
+            self.failures = 0
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                if self.state != "open":
+                    print(f"[WARNING] Circuit opened after {self.failures} failures in a row")
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+    def is_open(self):
+        return self.state != "closed"
+
+
+class LatencyWindow:
+    # The most recent `size` latencies of an endpoint
+    def __init__(self, size=200, min_samples=20):
+        self.samples = deque(maxlen=size)
+        self.min_samples = min_samples
+
+    def add(self, seconds):
+        self.samples.append(seconds)
+
+    def percentile(self, fraction):
+        # None until enough samples have been seen to trust the estimate
+        if len(self.samples) < self.min_samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
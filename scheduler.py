@@ -0,0 +1,134 @@
+import pytz, metrics
+from datetime import datetime, timedelta
+from threading import Thread, Condition
+
+# Refresh scheduler: each job (one per country, plus the combined guide) runs on its own
+# interval, offset from the others so upstream requests and EPG builds are spread over the
+# interval instead of arriving in one burst. At most `concurrency` jobs run at once, failed
+# jobs are retried with exponential backoff, and a supervisor replaces worker threads that die.
+#
+# A job function returns None on success; anything else (or an exception) is a failure.
+
+JOB_SECONDS = metrics.histogram("pluto_refresh_job_seconds", "Duration of each refresh job run", ("job", "result"),
+                                buckets=(0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0))
+
+
+class Job:
+    def __init__(self, name, func, interval, order, now):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.order = order
+        # The regular slot this job runs in; the first run happens straight away
+        self.slot = now
+        self.next_run = now
+        self.last_run = None
+        self.last_duration = None
+        self.last_error = None
+        self.failures = 0
+        self.running = False
+
+    def status(self):
+        return {'running': self.running,
+                'last_run': self.last_run.isoformat() if self.last_run else None,
+                'last_duration': round(self.last_duration, 3) if self.last_duration is not None else None,
+                'last_error': self.last_error,
+                'failures': self.failures,
+                'next_run': self.next_run.isoformat()}
+
+
+class RefreshScheduler:
+    def __init__(self, interval, concurrency=1, backoff=timedelta(minutes=1), supervise_every=30):
+        self.interval = interval
+        self.concurrency = max(1, concurrency)
+        self.backoff = backoff
+        self.supervise_every = supervise_every
+        self.jobs = {}
+        self.workers = []
+        self.condition = Condition()
+
+    def add(self, name, func):
+        with self.condition:
+            self.jobs[name] = Job(name, func, self.interval, len(self.jobs), datetime.now(pytz.utc))
+            # Spread the regular slots of jobs that have not run yet evenly over the interval, in the order they were added
+            step = self.interval / len(self.jobs)
+            for job in self.jobs.values():
+                if job.last_run is None:
+                    job.slot = job.next_run + step * job.order
+            self.condition.notify_all()
+
+    def status(self):
+        with self.condition:
+            return {name: job.status() for name, job in self.jobs.items()}
+
+    def run_all(self):
+        # Runs every job once, in the order they were added, on the calling thread (used by the benchmarks)
+        for job in sorted(self.jobs.values(), key=lambda job: job.order):
+            with self.condition:
+                job.running = True
+            self.run(job)
+
+    def start(self):
+        print(f"[INFO] Initializing Scheduler: {len(self.jobs)} jobs every {self.interval}, {self.concurrency} at a time")
+        Thread(target=self.supervise, daemon=True).start()
+
+    def supervise(self):
+        # Keep `concurrency` worker threads alive; a thread that has died is replaced, never restarted
+        while True:
+            alive = [worker for worker in self.workers if worker.is_alive()]
+            if len(alive) < len(self.workers):
+                print(f"[ERROR] {len(self.workers) - len(alive)} scheduler worker(s) stopped. Restarting...")
+            while len(alive) < self.concurrency:
+                worker = Thread(target=self.work, daemon=True)
+                worker.start()
+                alive.append(worker)
+            self.workers = alive
+            with self.condition:
+                self.condition.wait(timeout=self.supervise_every)
+
+    def work(self):
+        while True:
+            self.run(self.next_due())
+
+    def next_due(self):
+        with self.condition:
+            while True:
+                now = datetime.now(pytz.utc)
+                due = [job for job in self.jobs.values() if not job.running and job.next_run <= now]
+                if due:
+                    job = min(due, key=lambda job: (job.next_run, job.order))
+                    job.running = True
+                    return job
+                upcoming = min((job.next_run for job in self.jobs.values() if not job.running), default=now + timedelta(minutes=1))
+                self.condition.wait(timeout=min(max((upcoming - now).total_seconds(), 0.1), 60))
+
+    def run(self, job):
+        started = datetime.now(pytz.utc)
+        # Stays set if the job takes its worker thread down with it
+        error = "Job did not complete"
+        try:
+            error = job.func()
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        finally:
+            finished = datetime.now(pytz.utc)
+            with self.condition:
+                job.running = False
+                job.last_run = started
+                job.last_duration = (finished - started).total_seconds()
+                job.last_error = str(error) if error else None
+                if error:
+                    # Retry sooner than the next slot, backing off exponentially while the failures continue
+                    job.failures += 1
+                    delay = min(self.backoff * 2 ** (job.failures - 1), job.interval)
+                    job.next_run = finished + delay
+                    print(f"[ERROR] Refresh job {job.name} failed ({job.failures} in a row), retrying in {delay}: {error}")
+                else:
+                    job.failures = 0
+                    # Move to the next slot, skipping one that would follow less than half an interval
+                    # after this run (only possible right after startup, when every job runs at once)
+                    while job.slot <= finished or job.slot - started < job.interval / 2:
+                        job.slot += job.interval
+                    job.next_run = job.slot
+                self.condition.notify_all()
+            JOB_SECONDS.observe(job.last_duration, job=job.name, result='error' if error else 'ok')
@@ -0,0 +1,279 @@
+import os, struct, time, zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Streaming XMLTV output.
+# Records are written one at a time in the same layout ET.indent(tree, '  ') + ET.tostring produced,
+# so the whole document never has to be held in memory.
+
+XML_DECLARATION = "<?xml version='1.0' encoding='utf-8'?>"
+DOCTYPE = '<!DOCTYPE tv SYSTEM "xmltv.dtd">'
+
+# Buffered output is flushed to the files once it grows past this many characters
+FLUSH_SIZE = 64 * 1024
+
+# Uncompressed size of each block compressed on its own thread
+BLOCK_SIZE = 1024 * 1024
+# Each block is primed with the end of the one before it, the most deflate can refer back to
+DICTIONARY_SIZE = 32 * 1024
+
+
+def escape_text(text):
+    # Same replacements ElementTree applies to element text
+    if "&" in text:
+        text = text.replace("&", "&amp;")
+    if "<" in text:
+        text = text.replace("<", "&lt;")
+    if ">" in text:
+        text = text.replace(">", "&gt;")
+    return text
+
+def escape_attrib(text):
+    # Same replacements ElementTree applies to attribute values
+    text = escape_text(text)
+    if "\"" in text:
+        text = text.replace("\"", "&quot;")
+    if "\r" in text:
+        text = text.replace("\r", "&#13;")
+    if "\n" in text:
+        text = text.replace("\n", "&#10;")
+    if "\t" in text:
+        text = text.replace("\t", "&#09;")
+    return text
+
+def start_tag(tag, attrib=None):
+    if not attrib:
+        return f"<{tag}"
+    return f"<{tag} " + " ".join(f'{key}="{escape_attrib(value)}"' for key, value in attrib.items())
+
+def sub_element(tag, attrib=None, text=None):
+    # Child of a record, indented two levels
+    if text:
+        return f"    {start_tag(tag, attrib)}>{escape_text(text)}</{tag}>\n"
+    return f"    {start_tag(tag, attrib)} />\n"
+
+def record(tag, attrib, children):
+    # Direct child of <tv> (<channel> or <programme>) with its pre-rendered sub elements
+    if not children:
+        return f"  {start_tag(tag, attrib)} />\n"
+    return f"  {start_tag(tag, attrib)}>\n" + "".join(children) + f"  </{tag}>\n"
+
+def channel_record(station_id, name, logo):
+    return record("channel", {"id": station_id},
+                  [sub_element("display-name", text=name),
+                   sub_element("icon", {"src": logo})])
+
+
+class ProgrammeCache:
+    # Rendered <programme> records keyed by (channel id, start, stop, episode id).
+    # Entries are kept until their programme has ended.
+    def __init__(self):
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key, fragment, stop):
+        self.entries[key] = (fragment, stop)
+
+    def evict(self, now):
+        # stop and now are ISO-8601 UTC strings in the same format, so they compare in time order
+        expired = [key for key, (fragment, stop) in self.entries.items() if stop <= now]
+        for key in expired:
+            del self.entries[key]
+        return len(expired)
+
+    def stats(self, reset=True):
+        lookups = self.hits + self.misses
+        stats = {"hits": self.hits,
+                 "misses": self.misses,
+                 "hit_rate": self.hits / lookups if lookups else 0.0,
+                 "entries": len(self.entries)}
+        if reset:
+            self.hits = 0
+            self.misses = 0
+        return stats
+
+
+def compress_block(data, level, dictionary, last):
+    # Raw deflate for one block, and the CPU time it took. Blocks before the last end on a byte boundary
+    # without closing the stream, so their output can be concatenated into a single deflate stream.
+    start = time.thread_time()
+    if dictionary:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL, zlib.Z_DEFAULT_STRATEGY, dictionary)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    output = compressor.compress(data) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+    return output, time.thread_time() - start
+
+
+class BlockCompressor:
+    # pigz-style gzip: the data is cut into blocks that are compressed in parallel and written, in order,
+    # as one deflate stream inside a single gzip member, so every gzip reader (HTTP clients decoding
+    # Content-Encoding: gzip included) sees the whole file. Each block is primed with the last 32 KiB
+    # of the one before it, which keeps the ratio close to compressing the file in one go.
+    # The CRC and length for the trailer are kept on the calling thread as the data arrives.
+    # zlib releases the GIL while it compresses, so threads run on separate cores.
+    # At most two blocks per thread are in flight, which bounds memory whatever the document size.
+    def __init__(self, fileobj, level=9, threads=1, block_size=BLOCK_SIZE):
+        self.fileobj = fileobj
+        self.level = level
+        self.threads = max(1, threads)
+        self.block_size = block_size
+        self.executor = ThreadPoolExecutor(self.threads) if self.threads > 1 else None
+        self.pending = deque()
+        self.buffer = bytearray()
+        self.dictionary = b""
+        self.crc = 0
+        self.blocks = 0
+        # Seconds the caller waited on compression, CPU seconds spent compressing, and bytes in and out
+        self.wait_seconds = 0.0
+        self.cpu_seconds = 0.0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        # No file name or modification time; the extra flags note the fastest and best levels as gzip does
+        extra_flags = 2 if level == 9 else 4 if level == 1 else 0
+        self.store(struct.pack("<4sIBB", b"\x1f\x8b\x08\x00", 0, extra_flags, 255))
+
+    def write(self, data):
+        self.buffer += data
+        self.crc = zlib.crc32(data, self.crc)
+        self.bytes_in += len(data)
+        # The newest block is held back until more data arrives, as only the last one finishes the stream
+        if len(self.buffer) > self.block_size:
+            start = time.perf_counter()
+            while len(self.buffer) > self.block_size:
+                self.submit(bytes(self.buffer[:self.block_size]), False)
+                del self.buffer[:self.block_size]
+            self.wait_seconds += time.perf_counter() - start
+
+    def submit(self, block, last):
+        dictionary = self.dictionary
+        self.dictionary = block[-DICTIONARY_SIZE:]
+        self.blocks += 1
+        if self.executor is None:
+            self.compressed(compress_block(block, self.level, dictionary, last))
+            return
+        self.pending.append(self.executor.submit(compress_block, block, self.level, dictionary, last))
+        while len(self.pending) > 2 * self.threads:
+            self.compressed(self.pending.popleft().result())
+
+    def compressed(self, result):
+        output, cpu_seconds = result
+        self.cpu_seconds += cpu_seconds
+        self.store(output)
+
+    def store(self, output):
+        self.fileobj.write(output)
+        self.bytes_out += len(output)
+
+    def close(self):
+        start = time.perf_counter()
+        try:
+            # The rest of the data (none at all for an empty document) finishes the deflate stream
+            self.submit(bytes(self.buffer), True)
+            self.buffer = bytearray()
+            while self.pending:
+                self.compressed(self.pending.popleft().result())
+            self.store(struct.pack("<II", self.crc, self.bytes_in & 0xffffffff))
+        finally:
+            self.abort()
+        self.wait_seconds += time.perf_counter() - start
+
+    def abort(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.executor = None
+        self.pending.clear()
+
+    def stats(self):
+        return {"compress_seconds": self.wait_seconds,
+                "compress_cpu_seconds": self.cpu_seconds,
+                "compress_threads": self.threads,
+                # Uncompressed bytes per CPU second, and uncompressed size over compressed size
+                "compress_throughput": self.bytes_in / self.cpu_seconds if self.cpu_seconds else 0.0,
+                "compression_ratio": self.bytes_in / self.bytes_out if self.bytes_out else 0.0}
+
+
+class XMLTVWriter:
+    # Writes the XMLTV document to xml_file_path and its gzip copy in a single pass.
+    # Both are written to temporary files and renamed into place on close, so readers never see a partial file.
+    def __init__(self, xml_file_path, attrib, compress_level=9, compress_threads=1):
+        self.xml_file_path = xml_file_path
+        self.compressed_file_path = f"{xml_file_path}.gz"
+        self.temp_file_path = f"{xml_file_path}.tmp"
+        self.temp_compressed_file_path = f"{self.compressed_file_path}.tmp"
+        self.root_tag = start_tag("tv", attrib)
+        self.records = 0
+        self.buffer = []
+        self.buffered = 0
+        # Bytes written, reported with each build
+        self.bytes_written = 0
+        self.compressed_bytes = 0
+
+        self.file = open(self.temp_file_path, "wb")
+        self.compressed_raw = open(self.temp_compressed_file_path, "wb")
+        self.compressor = BlockCompressor(self.compressed_raw, compress_level, compress_threads)
+        self._write(XML_DECLARATION + "\n" + DOCTYPE + "\n")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, fragment):
+        if self.records == 0:
+            self._write(self.root_tag + ">\n")
+        self.records += 1
+        self._write(fragment)
+
+    def _write(self, text):
+        self.buffer.append(text)
+        self.buffered += len(text)
+        if self.buffered >= FLUSH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        data = "".join(self.buffer).encode("utf-8")
+        self.file.write(data)
+        self.bytes_written += len(data)
+        self.compressor.write(data)
+        self.buffer = []
+        self.buffered = 0
+
+    def close(self):
+        if self.file.closed:
+            return
+        # An empty document is written as a self-closing root, as ElementTree does
+        self._write("</tv>" if self.records else self.root_tag + " />")
+        self.flush()
+        self.file.close()
+        self.compressor.close()
+        self.compressed_bytes = self.compressed_raw.tell()
+        self.compressed_raw.close()
+        os.replace(self.temp_file_path, self.xml_file_path)
+        os.replace(self.temp_compressed_file_path, self.compressed_file_path)
+
+    def abort(self):
+        # Discard the partial output and leave any previous files in place
+        if self.file.closed:
+            return
+        self.file.close()
+        self.compressor.abort()
+        self.compressed_raw.close()
+        for path in (self.temp_file_path, self.temp_compressed_file_path):
+            if os.path.exists(path):
+                os.remove(path)